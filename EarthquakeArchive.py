@@ -0,0 +1,162 @@
+"""
+Description: SQLite archive of every event seen
+
+The feeds only cover the last hour to month, so each fetched feed is
+added to an archive that keeps growing.  Events are keyed on the USGS
+id and a row is only rewritten when USGS has updated the event, so
+ingesting a refreshed feed leaves unchanged events alone.  Time,
+magnitude and location are indexed so queries over years of events
+stay quick.
+"""
+
+import threading
+import time
+
+import logging
+
+from EarthquakeSpatial import distanceKm, radiusBox
+from EarthquakeStore import ALERTS, NO_VALUE, EventStore
+
+ArchiveFile = 'earthquake_archive.sqlite'
+# Used as the feed url when the GUI shows the archive
+ARCHIVE_URL = "archive:"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    updated INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    mag REAL NOT NULL,
+    mmi REAL NOT NULL,
+    alert INTEGER NOT NULL,
+    felt INTEGER,
+    tz INTEGER,
+    place TEXT NOT NULL,
+    url TEXT,
+    lon REAL NOT NULL,
+    lat REAL NOT NULL,
+    depth REAL NOT NULL,
+    sig INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_mag ON events (mag);
+CREATE INDEX IF NOT EXISTS events_location ON events (lat, lon);
+"""
+
+_columns = ("id", "updated", "time", "mag", "mmi", "alert", "felt", "tz",
+            "place", "url", "lon", "lat", "depth", "sig")
+
+# Insert new events, and overwrite an existing one only if USGS has
+# updated it since, or it was archived before sig was kept
+_upsert = (
+    f"INSERT INTO events ({', '.join(_columns)}) "
+    f"VALUES ({', '.join('?' * len(_columns))}) "
+    "ON CONFLICT (id) DO UPDATE SET "
+    + ", ".join(f"{c} = excluded.{c}" for c in _columns[1:])
+    + " WHERE excluded.updated > events.updated"
+    " OR (events.sig IS NULL AND excluded.sig IS NOT NULL)")
+
+
+class EventArchive:
+    # One connection per thread, as sqlite3 connections may not be
+    # shared between threads.  Nothing is opened until the archive is
+    # first used.
+    def __init__(self, path=ArchiveFile):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            import sqlite3
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.executescript(_schema)
+            # archives made before sig was kept
+            known = {row[1] for row in connection.execute(
+                "PRAGMA table_info(events)")}
+            if "sig" not in known:
+                with connection:
+                    connection.execute(
+                        "ALTER TABLE events ADD COLUMN sig INTEGER")
+            self._local.connection = connection
+        return connection
+
+    def ingest(self, events):
+        # Add a store of events to the archive
+        # output: number of events added or updated
+        def rows():
+            for row in range(len(events)):
+                felt, tz, sig = (events.felt[row], events.tz[row],
+                                 events.sig[row])
+                yield (
+                    events.ids[row], events.updated[row], events.time[row],
+                    events.mag[row], events.mmi[row], events.alert[row],
+                    None if felt == NO_VALUE else felt,
+                    None if tz == NO_VALUE else tz,
+                    events.place[row], events.url[row],
+                    events.lon[row], events.lat[row], events.depth[row],
+                    None if sig == NO_VALUE else sig)
+
+        connection = self._connection()
+        before = connection.total_changes
+        with connection:
+            connection.executemany(_upsert, rows())
+        changed = connection.total_changes - before
+        logging.debug(f"archive: {changed} of {len(events)} changed")
+        return changed
+
+    def query(self, minMag=None, maxMag=None, since=None, until=None,
+              near=None, box=None, limit=None):
+        # Events matching every given criterion, newest first
+        #   since, until - ms since the epoch
+        #   near - (lat, lon, km), box - (south, west, north, east)
+        # output: EventStore
+        where = []
+        params = []
+        for column, op, value in (("mag", ">=", minMag),
+                                  ("mag", "<=", maxMag),
+                                  ("time", ">=", since),
+                                  ("time", "<=", until)):
+            if value is not None:
+                where.append(f"{column} {op} ?")
+                params.append(value)
+        for area in (box, None if near is None else radiusBox(*near)):
+            if area is None:
+                continue
+            south, west, north, east = area
+            where.append("lat BETWEEN ? AND ?")
+            params += [south, north]
+            if west <= east:
+                where.append("lon BETWEEN ? AND ?")
+            else:
+                where.append("(lon >= ? OR lon <= ?)")
+            params += [west, east]
+        sql = f"SELECT {', '.join(_columns)} FROM events"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY time DESC"
+        # a radius query is cut down after the SQL, so no LIMIT then
+        if limit is not None and near is None:
+            sql += f" LIMIT {int(limit)}"
+        events = EventStore()
+        for (eventId, updated, eventTime, mag, mmi, alert, felt, tz,
+             place, url, lon, lat, depth, sig) in self._connection().execute(
+                sql, params):
+            if near is not None:
+                if distanceKm(near[0], near[1], lat, lon) > near[2]:
+                    continue
+                if limit is not None and len(events) >= limit:
+                    break
+            events.append([eventId, mag, place, eventTime, tz, url, felt,
+                           ALERTS[alert], mmi, lon, lat, depth, updated,
+                           sig])
+        return events
+
+    def header(self, events):
+        # A header like loadHeaderInfo's for events from the archive
+        return {
+            "timeStamp": int(time.time() * 1000),
+            "url": ARCHIVE_URL,
+            "title": "Earthquake archive",
+            "count": len(events),
+        }
@@ -0,0 +1,204 @@
+"""
+Description: Loading events older than the summary feeds from the USGS
+FDSN event service
+
+The summary feeds only go back 30 days.  The FDSN event service answers
+any time range, but refuses a query that matches more than 20,000
+events.  The range is split into windows, each window is downloaded on
+a pool of threads (retrying failures with a growing delay) and a window
+that turns out to be too big is split in two and asked for again.  The
+GeoJSON of each window is parsed by readFeed, the same as the live
+feeds, in a pool of processes, and the windows are merged newest first
+with each event kept once, in its most recently updated version.
+"""
+
+import gzip
+import io
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from datetime import datetime, timezone
+
+import logging
+
+from EarthquakeData import readFeed, readHeader
+from EarthquakeMetrics import metrics
+from EarthquakeStore import EventStore
+
+FDSN_BASE = "https://earthquake.usgs.gov/fdsnws/event/1/"
+# Most events the service returns for one query
+MAX_EVENTS = 20000
+# Length of the windows the range is first split into.  A month of
+# every magnitude is usually well under MAX_EVENTS.
+WINDOW_MS = 30 * 86400 * 1000
+# Windows are not split below this, a window this short that is still
+# too big is an error (ms)
+MIN_WINDOW_MS = 60 * 1000
+RETRIES = 4
+# Seconds before the first retry, doubled for each one after
+RETRY_DELAY = 1.0
+TIMEOUT = 120
+
+
+class BackfillError(Exception):
+    pass
+
+
+class _TooBig(Exception):
+    # The window matches more events than the service will return
+    pass
+
+
+def parseTime(text):
+    # "2024-01-31" or an ISO 8601 time to ms since the epoch.  Times
+    # with no zone are UTC.
+    moment = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def _isoTime(ms):
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+def queryUrl(start, end, minMag=None, base=FDSN_BASE):
+    # GeoJSON query for the events from start up to end (ms)
+    params = {
+        "format": "geojson",
+        "starttime": _isoTime(start),
+        "endtime": _isoTime(end),
+        "orderby": "time",
+    }
+    if minMag is not None:
+        params["minmagnitude"] = minMag
+    return f"{base}query?{urllib.parse.urlencode(params)}"
+
+
+def windows(start, end, length=WINDOW_MS):
+    # (start, end) windows covering start..end, newest first
+    result = []
+    while end > start:
+        result.append((max(start, end - length), end))
+        end -= length
+    return result
+
+
+def fetchWindow(url, retries=RETRIES, delay=RETRY_DELAY):
+    # The GeoJSON for one window.  Network errors, server errors and
+    # "too many requests" are retried.
+    # output: the response body, uncompressed
+    request = urllib.request.Request(
+        url, headers={"Accept-Encoding": "gzip"})
+    for attempt in range(retries + 1):
+        try:
+            with metrics.timer("backfill_download"):
+                with urllib.request.urlopen(request,
+                                            timeout=TIMEOUT) as response:
+                    data = response.read()
+                    encoding = response.headers.get("Content-Encoding", "")
+            if encoding.lower() == "gzip":
+                data = gzip.decompress(data)
+            metrics.count("backfill_bytes", len(data))
+            return data
+        except urllib.error.HTTPError as e:
+            if e.code == 400 and b"limit" in e.read():
+                raise _TooBig()
+            if e.code != 429 and e.code < 500:
+                raise BackfillError(f"HTTP {e.code} for {url}")
+            error = f"HTTP {e.code}"
+        except (urllib.error.URLError, OSError, EOFError) as e:
+            error = str(e)
+        if attempt < retries:
+            metrics.count("backfill_retries")
+            logging.warning(f"retrying window - {error}\n{url}")
+            time.sleep(delay * 2 ** attempt)
+    raise BackfillError(f"{error} for {url}")
+
+
+def _download(window, minMag, base, retries, delay):
+    # fetchWindow for a window, raising _TooBig for a full response as
+    # well, in case the service cut it short instead of refusing it
+    data = fetchWindow(queryUrl(*window, minMag, base), retries, delay)
+    if readHeader(io.BytesIO(data))["count"] >= MAX_EVENTS:
+        raise _TooBig()
+    return data
+
+
+def parseWindow(data):
+    # Runs in a worker process
+    # output: (EventStore of the window's events, the metrics collected
+    #         here)
+    return readFeed(io.BytesIO(data))[1], metrics.take()
+
+
+def _parsed(future):
+    events, collected = future.result()
+    metrics.merge(collected)
+    return events
+
+
+def mergeStores(stores):
+    # One store of the events in all the stores, newest first.  An
+    # event in more than one is kept in its most recently updated
+    # version.
+    newest = {}
+    for store in stores:
+        for row, eventId in enumerate(store.ids):
+            found = newest.get(eventId)
+            if (found is None
+                    or store.updated[row] > found[0].updated[found[1]]):
+                newest[eventId] = (store, row)
+    merged = EventStore()
+    for store, row in sorted(newest.values(),
+                             key=lambda e: e[0].time[e[1]], reverse=True):
+        merged.append(store.event(row))
+    return merged
+
+
+def backfill(start, end, minMag=None, base=FDSN_BASE, jobs=4,
+             parseJobs=1, retries=RETRIES, delay=RETRY_DELAY):
+    # The events from start up to end (ms since the epoch), newest
+    # first, in as many queries as the service limit needs.  Windows
+    # are downloaded jobs at a time and parsed in parseJobs processes
+    # (in this one if 1) as they come in.
+    # output: EventStore
+    if parseJobs > 1:
+        parser = ProcessPoolExecutor(max_workers=parseJobs,
+                                     initializer=metrics.reset)
+    else:
+        parser = ThreadPoolExecutor(max_workers=1)
+    parsed = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool, parser:
+        downloads = {
+            pool.submit(_download, window, minMag, base, retries, delay):
+                window for window in windows(start, end)}
+        while downloads:
+            done, _ = wait(downloads, return_when=FIRST_COMPLETED)
+            for future in done:
+                window = downloads.pop(future)
+                try:
+                    data = future.result()
+                except _TooBig:
+                    first, last = window
+                    if last - first <= MIN_WINDOW_MS:
+                        raise BackfillError(
+                            f"more than {MAX_EVENTS:,} events between "
+                            f"{_isoTime(first)} and {_isoTime(last)}")
+                    metrics.count("backfill_splits")
+                    middle = (first + last) // 2
+                    for half in ((middle, last), (first, middle)):
+                        downloads[pool.submit(_download, half, minMag,
+                                              base, retries, delay)] = half
+                    continue
+                metrics.count("backfill_windows")
+                parsed[window] = parser.submit(parseWindow, data)
+        with metrics.timer("backfill_merge"):
+            # windows newest first, as the events in them are
+            return mergeStores(_parsed(parsed[window])
+                               for window in sorted(parsed, reverse=True))
+
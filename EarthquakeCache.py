@@ -0,0 +1,226 @@
+"""
+Description: On-disk cache of USGS summary feeds
+
+Every feed is kept in its own file, named after the feed (4.5_week,
+all_day, ...).  The index records when each feed was generated, its
+ETag/Last-Modified and when it was last used.  A feed is fresh until
+USGS is due to regenerate it, and the least recently used feeds are
+removed when the cache grows past its size limit.  A feed may also have
+a binary snapshot of its parsed events beside it.  The index is saved
+with the files so it survives restarts: at once when a feed is stored
+or checked, and at most every SAVE_SECONDS (and by flush()) when feeds
+have only been used.  A FeedCache may be shared by several threads.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import logging
+
+CacheDir = 'earthquake_cache'
+IndexFile = 'index.json'
+# Size limit for all cached feeds together, in bytes
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+# Longest the last used times may go unsaved, in seconds
+SAVE_SECONDS = 30
+
+FEED_BASE = "https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/"
+# The summary feeds USGS publishes, e.g. 4.5_week
+FEED_LEVELS = ("significant", "4.5", "2.5", "1.0", "all")
+FEED_PERIODS = ("hour", "day", "week", "month")
+FEED_NAMES = tuple(f"{level}_{period}"
+                   for period in FEED_PERIODS for level in FEED_LEVELS)
+
+# How often USGS regenerates the feeds for each time period, in seconds
+UPDATE_INTERVAL = {
+    "hour": 60,
+    "day": 60,
+    "week": 60,
+    "month": 15 * 60,
+}
+DEFAULT_INTERVAL = 60
+
+_feedPattern = re.compile(r"summary/([^/?#]+)\.geojson")
+
+
+def feedName(urlData):
+    # Name of the feed in a summary url, e.g. 2.5_day.  Other urls get
+    # a name made from a hash of the url.
+    match = _feedPattern.search(urlData)
+    if match:
+        return match.group(1)
+    return "url_" + hashlib.sha1(urlData.encode()).hexdigest()[:16]
+
+
+def feedUrl(name, base=FEED_BASE):
+    return f"{base}{name}.geojson"
+
+
+def updateInterval(name):
+    # seconds between USGS updates for a feed name like 4.5_week
+    period = name.rpartition("_")[2]
+    return UPDATE_INTERVAL.get(period, DEFAULT_INTERVAL)
+
+
+class FeedCache:
+    def __init__(self, directory=CacheDir, maxBytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.indexPath = os.path.join(directory, IndexFile)
+        self.lock = threading.RLock()
+        self.index = self._loadIndex()
+        # monotonic time of the last save, and whether the index has
+        # changed since
+        self._saved = 0.0
+        self._unsaved = False
+
+    def _loadIndex(self):
+        try:
+            with open(self.indexPath, "r") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.error(f"\nError reading cache index - {self.indexPath}")
+            return {}
+        # forget entries whose file has gone
+        return {name: entry for name, entry in index.items()
+                if os.path.exists(self.path(name))}
+
+    def save(self):
+        # Nothing is written once the cache directory has been removed.
+        # It is made when the first feed is stored.
+        if not os.path.isdir(self.directory):
+            return
+        partFile = f"{self.indexPath}.{os.getpid()}.part"
+        try:
+            with self.lock:
+                with open(partFile, "w") as f:
+                    json.dump(self.index, f)
+                os.replace(partFile, self.indexPath)
+                self._saved = time.monotonic()
+                self._unsaved = False
+        except OSError:
+            logging.error(f"\nError writing cache index - {self.indexPath}")
+
+    def flush(self):
+        # save the index if uses have been recorded since the last save
+        with self.lock:
+            if self._unsaved:
+                self.save()
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".geojson")
+
+    def snapshotPath(self, name):
+        return os.path.join(self.directory, name + ".snap")
+
+    def _remove(self, name):
+        # delete the files of a feed that is no longer in the index
+        for path in (self.path(name), self.snapshotPath(name)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def partPath(self, name):
+        # temporary file to download into before calling store().  Each
+        # thread gets its own so two downloads of a feed do not clash.
+        os.makedirs(self.directory, exist_ok=True)
+        return f"{self.path(name)}.{threading.get_ident()}.part"
+
+    def get(self, name, use=True):
+        # index entry for a feed, or None if it is not cached.  With use
+        # it counts as a use for the LRU order, which is only written
+        # out with the next save.
+        with self.lock:
+            entry = self.index.get(name)
+            if entry is None:
+                return None
+            if not os.path.exists(self.path(name)):
+                del self.index[name]
+                self._remove(name)
+                self.save()
+                return None
+            if use:
+                entry["lastUsed"] = time.time()
+                self._unsaved = True
+                if time.monotonic() - self._saved >= SAVE_SECONDS:
+                    self.save()
+            return entry
+
+    def mostRecent(self):
+        # name of the feed used last, or None if the cache is empty
+        with self.lock:
+            if not self.index:
+                return None
+            return max(self.index,
+                       key=lambda n: self.index[n]["lastUsed"])
+
+    def lastChecked(self, name):
+        # time (seconds since the epoch) the cached copy was last known
+        # to be current, 0 if it is not cached
+        entry = self.index.get(name)
+        if entry is None:
+            return 0
+        generated = (entry.get("generated") or 0) / 1000
+        return max(generated, entry.get("checked", 0))
+
+    def expires(self, name):
+        # time (seconds since the epoch) the cached copy goes stale
+        if name not in self.index:
+            return 0
+        return self.lastChecked(name) + updateInterval(name)
+
+    def isFresh(self, name, now=None):
+        if now is None:
+            now = time.time()
+        return now < self.expires(name)
+
+    def store(self, name, partFile, generated, etag=None,
+              lastModified=None):
+        # Move a completed download into the cache and record it
+        with self.lock:
+            os.replace(partFile, self.path(name))
+            now = time.time()
+            self.index[name] = {
+                "size": os.path.getsize(self.path(name)),
+                "generated": generated,
+                "etag": etag,
+                "lastModified": lastModified,
+                "checked": now,
+                "lastUsed": now,
+            }
+            self.evict(keep=name)
+            self.save()
+
+    def markChecked(self, name):
+        # USGS said the cached copy is still current (HTTP 304)
+        with self.lock:
+            entry = self.index.get(name)
+            if entry is not None:
+                entry["checked"] = entry["lastUsed"] = time.time()
+                self.save()
+
+    def size(self):
+        with self.lock:
+            return sum(entry["size"] for entry in self.index.values())
+
+    def evict(self, keep=None):
+        # Remove least recently used feeds until under the size limit
+        with self.lock:
+            total = self.size()
+            for name in sorted(self.index,
+                               key=lambda n: self.index[n]["lastUsed"]):
+                if total <= self.maxBytes:
+                    break
+                if name == keep:
+                    continue
+                total -= self.index[name]["size"]
+                del self.index[name]
+                self._remove(name)
+                logging.debug(f"removed {name} from the cache")
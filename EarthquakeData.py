@@ -1,7 +1,22 @@
+import atexit
+import codecs
+import gzip
+import http.client
 import json
+import os
+import re
+import socket
+import threading
+import time
 import urllib.request
 
 import logging
+from collections import namedtuple
+
+from EarthquakeCache import FeedCache, feedName
+from EarthquakeMetrics import metrics
+from EarthquakeSnapshot import readSnapshot, writeSnapshot
+from EarthquakeStore import EventStore
 
 logging.basicConfig(
     level=logging.INFO,
@@ -9,22 +24,113 @@ logging.basicConfig(
     '%(funcName)20s:%(message)s', datefmt='%Y%m%d %H:%M:%S',)
 
 
-JSONFile = 'earthquake.json'
+# Size of the pieces read from the web or the cache file while streaming
+CHUNK_SIZE = 64 * 1024
+# Seconds to wait for USGS to connect or send the next piece before the
+# download is given up, so a stalled one does not hold the feed's lock
+TIMEOUT = 60
+
+_decoder = json.JSONDecoder()
+_blanks = re.compile(r"[ \t\n\r]*")
+_cache = None
+_cacheLock = threading.Lock()
+# One lock per feed name, so only one thread fetches a feed at a time
+_feedLocks = {}
+_feedLocksLock = threading.Lock()
+
+
+class FetchCancelled(Exception):
+    # Raised by a progress callback to stop a download or file read
+    pass
+
+
+def _timedConnection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                     source_address=None, *args, **kwargs):
+    # socket.create_connection with the DNS lookup and the connect
+    # timed as separate stages
+    host, port = address
+    with metrics.timer("dns"):
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    error = None
+    with metrics.timer("connect"):
+        for family, kind, proto, name, sockaddr in addresses:
+            try:
+                return socket.create_connection(
+                    sockaddr[:2], timeout, source_address)
+            except OSError as e:
+                error = e
+    raise error
+
+
+class _TimedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _timedConnection
+
+
+class _TimedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _timedConnection
+
+
+class _TimedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_TimedHTTPConnection, req)
+
 
+class _TimedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_TimedHTTPSConnection, req,
+                            context=self._context)
 
-def getDataFile():
+
+# urlopen that records the DNS and connect times
+_opener = urllib.request.build_opener(_TimedHTTPHandler, _TimedHTTPSHandler)
+
+
+def getCache():
+    # The feed cache shared by everything in this process.  Threads
+    # asking for it at once must all get the same one.
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            _cache = FeedCache()
+            # the last used times are only saved now and then
+            atexit.register(_cache.flush)
+    return _cache
+
+
+def _feedLock(name):
+    with _feedLocksLock:
+        lock = _feedLocks.get(name)
+        if lock is None:
+            lock = _feedLocks[name] = threading.Lock()
+        return lock
+
+
+def _cachedName(urlData):
+    # feed name to read from the cache, the last one used if no url
+    if urlData is None:
+        return getCache().mostRecent()
+    return feedName(urlData)
+
+
+def getDataFile(urlData=None):
     # get data from a stored file.  When multiple requests are made, it
-    # saves going to the web each time.
+    # saves going to the web each time.  Without a url it returns the
+    # feed used last.
     # output: a JSON file. If the file does not exist it returns None.
-    logging.debug(f"")
+    cache = getCache()
+    name = _cachedName(urlData)
+    if name is None or cache.get(name) is None:
+        return None
     try:
-        with open(JSONFile, "r") as f:
+        with open(cache.path(name), "r") as f:
             data = f.read()
-    except FileNotFoundError:
-        return None
     except OSError:
         logging.error(
-            f"\nError reading file - {JSONFile}.")
+            f"\nError reading file - {cache.path(name)}.")
         return None
     return json.loads(data)
 
@@ -34,7 +140,7 @@ def getWebData(urlData):
         f"\nReading url - {urlData}.")
     # get data from the web and write to a file if successful
     try:
-        webUrl = urllib.request.urlopen(urlData)
+        webUrl = urllib.request.urlopen(urlData, timeout=TIMEOUT)
     except urllib.error.URLError as e:
         logging.error(f"URL access error - {e.reason}")
         return None
@@ -42,9 +148,16 @@ def getWebData(urlData):
         data = webUrl.read()
         try:
             theJSON = json.loads(data)
-            # write json data to a file
-            with open(JSONFile, "w") as f:
-                json.dump(theJSON, f)
+            # write the bytes as received, there is no need to
+            # serialise the parsed data again
+            cache = getCache()
+            name = feedName(urlData)
+            partFile = cache.partPath(name)
+            with open(partFile, "wb") as f:
+                f.write(data)
+            cache.store(name, partFile, theJSON["metadata"]["generated"],
+                        webUrl.headers.get("ETag"),
+                        webUrl.headers.get("Last-Modified"))
             return theJSON
         except:
             logging.error(
@@ -56,40 +169,402 @@ def getWebData(urlData):
         return None
 
 
-def loadList(JSONData):
+def getFileFeed(urlData=None, progress=None, use=True):
+    # Streaming version of getDataFile.  The feed comes from its binary
+    # snapshot when that is up to date, otherwise the cached file is
+    # parsed one feature at a time and a new snapshot written.  Without
+    # a url it returns the feed used last.  progress(bytesRead,
+    # totalBytes) is called as the file is read.  use=False leaves the
+    # feed's place in the LRU order alone.
+    # output: (header, EventStore) or None if the feed is not cached.
+    cache = getCache()
+    name = _cachedName(urlData)
+    if name is None or cache.get(name, use) is None:
+        metrics.count("file_cache_misses")
+        return None
+    with metrics.timer("snapshot"):
+        feed = readSnapshot(cache.snapshotPath(name), cache.path(name))
+    if feed is not None:
+        metrics.count("snapshot_hits")
+        metrics.gauge("events", len(feed[1]))
+        return feed
+    metrics.count("snapshot_misses")
+    try:
+        with open(cache.path(name), "rb") as f:
+            stat = os.fstat(f.fileno())
+            feed = readFeed(_ByteCounter(f, progress, stat.st_size,
+                                         "read"))
+        writeSnapshot(cache.snapshotPath(name), stat, *feed)
+        return feed
+    except FileNotFoundError:
+        return None
+    except OSError:
+        logging.error(
+            f"\nError reading file - {cache.path(name)}.")
+        return None
+    except ValueError:
+        logging.error(
+            f"\nBad data in file - {cache.path(name)}.")
+        return None
+
+
+def getFileHeader(urlData=None):
+    # Header of a cached feed without reading its events
+    # output: header or None if the feed is not cached.
+    cache = getCache()
+    name = _cachedName(urlData)
+    if name is None or cache.get(name) is None:
+        return None
+    try:
+        with open(cache.path(name), "rb") as f:
+            return readHeader(f)
+    except (OSError, ValueError):
+        logging.error(
+            f"\nError reading file - {cache.path(name)}.")
+        return None
+
+
+# What getWebFeed returns.  status is the HTTP status (200 or 304), or
+# None when the cached copy was fresh and no request was made.
+# bytesTransferred is the size of the body on the wire (compressed if
+# the server used gzip) and fromCache is True when the data came from
+# the cache rather than the response.
+FetchResult = namedtuple(
+    "FetchResult", "header events status bytesTransferred fromCache")
+
+
+def getWebFeed(urlData, current=None, progress=None, parse=True):
+    # Streaming version of getWebData.  Features are parsed as they come
+    # off the socket and the raw bytes are copied to the cache file
+    # unchanged, so the feed is never held in memory as one document.
+    # A fresh cached copy is used without going to the web.  Otherwise
+    # the request is conditional on the ETag/Last-Modified of the cached
+    # copy and asks for gzip.  When the cached copy is used the
+    # (header, events) passed in current are returned as they are,
+    # otherwise the cache file is read.  progress(bytesRead, totalBytes)
+    # is called as the download comes in, totalBytes being None if the
+    # server does not say.  It may raise FetchCancelled to give up.
+    # With parse=False only the header is read and events is None, for
+    # callers that parse the cached file somewhere else.  Threads asking
+    # for a feed that is already being fetched wait for that fetch and
+    # then use the fresh cached copy.
+    # output: FetchResult or None on error.
+    logging.debug(
+        f"\nReading url - {urlData}.")
+    name = feedName(urlData)
+    with _feedLock(name):
+        return _fetchFeed(urlData, name, current, progress, parse)
+
+
+def _fetchFeed(urlData, name, current, progress, parse):
+    cache = getCache()
+    entry = cache.get(name)
+    if entry is not None and cache.isFresh(name):
+        metrics.count("cache_hits")
+        return _fromCache(urlData, current, None, progress, parse)
+    request = urllib.request.Request(
+        urlData, headers={"Accept-Encoding": "gzip"})
+    if entry is not None:
+        if entry.get("etag"):
+            request.add_header("If-None-Match", entry["etag"])
+        if entry.get("lastModified"):
+            request.add_header("If-Modified-Since", entry["lastModified"])
+    try:
+        with metrics.timer("request"):
+            webUrl = _opener.open(request, timeout=TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and entry is not None:
+            metrics.count("cache_revalidated")
+            cache.markChecked(name)
+            return _fromCache(urlData, current, 304, progress, parse)
+        logging.error(
+            f"\nError from website - code: {e.code}\n{urlData}")
+        return None
+    except urllib.error.URLError as e:
+        logging.error(f"URL access error - {e.reason}")
+        return None
+    except OSError as e:
+        # a timeout waiting for the response headers
+        logging.error(f"\nError from website - {e}\n{urlData}")
+        return None
+    if webUrl.getcode() != 200:
+        logging.error(
+            f"\nError from website - code: {webUrl.getcode()}\n{urlData}")
+        return None
+    metrics.count("cache_misses")
+    # write to a temporary file first so a broken download never
+    # replaces a good cache file
+    partFile = cache.partPath(name)
+    length = webUrl.headers.get("Content-Length")
+    wire = _ByteCounter(webUrl, progress, int(length) if length else None,
+                        "download")
+    try:
+        with webUrl, open(partFile, "wb") as f:
+            if webUrl.headers.get("Content-Encoding", "").lower() == "gzip":
+                tee = _CacheWriter(gzip.GzipFile(fileobj=wire), f)
+            else:
+                tee = _CacheWriter(wire, f)
+            if parse:
+                header, events = readFeed(tee)
+            else:
+                header, events = readHeader(tee), None
+            tee.drain()
+            f.flush()
+            written = os.fstat(f.fileno())
+        cache.store(name, partFile, header["timeStamp"],
+                    webUrl.headers.get("ETag"),
+                    webUrl.headers.get("Last-Modified"))
+        if parse:
+            with metrics.timer("snapshot_write"):
+                writeSnapshot(cache.snapshotPath(name), written, header,
+                              events)
+    except (OSError, ValueError, EOFError, FetchCancelled) as e:
+        try:
+            os.remove(partFile)
+        except OSError:
+            pass
+        if isinstance(e, FetchCancelled):
+            raise
+        logging.error(
+            f"\nError reading data from website - {e}\n{urlData}")
+        return None
+    metrics.count("download_bytes", wire.bytesRead)
+    return FetchResult(header, events, 200, wire.bytesRead, False)
+
+
+def _fromCache(urlData, current, status, progress, parse=True):
+    # The cached copy is current, so use what the caller already has
+    if not parse:
+        header = getFileHeader(urlData)
+        if header is None:
+            return None
+        return FetchResult(header, None, status, 0, True)
+    if current is None:
+        current = getFileFeed(urlData, progress)
+        if current is None:
+            return None
+    header, events = current
+    return FetchResult(header, events, status, 0, True)
+
+
+class _ByteCounter:
+    # Counts the bytes read from a binary stream and reports them to an
+    # optional progress callback.  The time spent waiting for the
+    # stream is recorded as the stage named, if any.
+    def __init__(self, stream, progress=None, total=None, stage=None):
+        self.stream = stream
+        self.progress = progress
+        self.total = total
+        self.stage = stage
+        self.bytesRead = 0
+
+    def read(self, size=-1):
+        if self.stage is None:
+            chunk = self.stream.read(size)
+        else:
+            with metrics.timer(self.stage):
+                chunk = self.stream.read(size)
+        self.bytesRead += len(chunk)
+        if self.progress is not None:
+            self.progress(self.bytesRead, self.total)
+        return chunk
+
+
+class _CacheWriter:
+    # Wraps a binary stream and copies every chunk read from it to a
+    # file
+    def __init__(self, stream, out):
+        self.stream = stream
+        self.out = out
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.out.write(chunk)
+        return chunk
+
+    def drain(self):
+        # copy anything left after the end of the JSON document
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+class _TimedReader:
+    # Adds up the time spent reading a binary stream
+    def __init__(self, stream):
+        self.stream = stream
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        t1 = time.perf_counter()
+        chunk = self.stream.read(size)
+        self.seconds += time.perf_counter() - t1
+        return chunk
+
+
+class _FeedScanner:
+    # Minimal incremental reader over a binary stream of JSON.  Only
+    # enough of the buffer to decode the next value is kept in memory.
+    def __init__(self, stream, chunkSize):
+        self.stream = stream
+        self.chunkSize = chunkSize
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.pos > self.chunkSize:
+            # drop the part of the buffer that has been used already
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.stream.read(self.chunkSize)
+        if not chunk:
+            self.eof = True
+            self.buf += self.utf8.decode(b"", final=True)
+            return False
+        self.buf += self.utf8.decode(chunk)
+        return True
+
+    def peek(self):
+        # next non-blank character, without using it up
+        while True:
+            self.pos = _blanks.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of feed")
+
+    def next(self):
+        ch = self.peek()
+        self.pos += 1
+        return ch
+
+    def expect(self, ch):
+        if self.next() != ch:
+            raise ValueError(f"expected '{ch}' in feed")
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # most likely the value runs past the end of the buffer
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            if end == len(self.buf) and not self.eof and self._fill():
+                # a number may carry on in the next chunk
+                continue
+            self.pos = end
+            return value
+
+
+def iterFeed(stream, chunkSize=CHUNK_SIZE):
+    # Walk the top level of a GeoJSON FeatureCollection read from a
+    # binary stream, yielding (key, value) pairs.  Each member of the
+    # "features" array is yielded on its own as ("feature", value).
+    scan = _FeedScanner(stream, chunkSize)
+    scan.expect("{")
+    if scan.peek() == "}":
+        return
+    while True:
+        key = scan.value()
+        scan.expect(":")
+        if key == "features":
+            scan.expect("[")
+            if scan.peek() == "]":
+                scan.next()
+            else:
+                while True:
+                    yield "feature", scan.value()
+                    ch = scan.next()
+                    if ch == "]":
+                        break
+                    if ch != ",":
+                        raise ValueError("expected ',' in feature list")
+        else:
+            yield key, scan.value()
+        ch = scan.next()
+        if ch == "}":
+            return
+        if ch != ",":
+            raise ValueError("expected ',' in feed")
+
+
+def readFeed(stream):
+    # Build the header and the event store from a stream in one pass.
+    # The time is recorded as reading the stream, decoding the JSON
+    # and extracting the fields into the store.
+    # output: (header, EventStore)
+    metadata = None
+    events = EventStore()
+    timed = _TimedReader(stream)
+    clock = time.perf_counter
+    extract = 0.0
+    t1 = clock()
+    for key, value in iterFeed(timed):
+        if key == "feature":
+            t2 = clock()
+            events.append(featureToRecord(value))
+            extract += clock() - t2
+        elif key == "metadata":
+            metadata = value
+    metrics.observe("decode", clock() - t1 - extract - timed.seconds)
+    metrics.observe("extract", extract)
+    metrics.count("events_parsed", len(events))
+    metrics.gauge("events", len(events))
+    if metadata is None:
+        raise ValueError("feed has no metadata")
+    return loadHeaderInfo({"metadata": metadata}), events
+
+
+def readHeader(stream):
+    # Header of a feed, reading no further than the metadata.  USGS
+    # puts the metadata before the features.
+    for key, value in iterFeed(stream):
+        if key == "metadata":
+            return loadHeaderInfo({"metadata": value})
+    raise ValueError("feed has no metadata")
+
+
+def featureToRecord(feature):
     # Added some error checking because the occasional data problem
     # causes an abort when sorting different data types
-    logging.debug(f"")
-    eList = []
-    # testList = []
+    properties = feature["properties"]
+    coordinates = feature["geometry"]["coordinates"]
+    return [
+        feature["id"],
+        properties["mag"] or 0.0,
+        properties["place"],
+        properties["time"],
+        properties["tz"],
+        properties["url"],
+        properties["felt"],
+        properties["alert"] or "",
+        properties["mmi"] or 0.0,
+        coordinates[0],
+        coordinates[1],
+        coordinates[2],
+        properties.get("updated"),
+        properties.get("sig"),
+    ]
+
+
+def loadList(JSONData):
+    return [featureToRecord(i) for i in JSONData["features"]]
+
+
+def loadStore(JSONData):
+    # Same as loadList but into a column based EventStore
+    events = EventStore()
     for i in JSONData["features"]:
-        if not i["properties"]["mag"]:
-            i["properties"]["mag"] = 0.0
-        if not i["properties"]["mmi"]:
-            i["properties"]["mmi"] = 0.0
-        if not i["properties"]["alert"]:
-            i["properties"]["alert"] = ""
-        eList.append(
-            [
-                i["id"],
-                i["properties"]["mag"],
-                i["properties"]["place"],
-                i["properties"]["time"],
-                i["properties"]["tz"],
-                i["properties"]["url"],
-                i["properties"]["felt"],
-                i["properties"]["alert"],
-                i["properties"]["mmi"],
-                i["geometry"]["coordinates"][0],
-                i["geometry"]["coordinates"][1],
-                i["geometry"]["coordinates"][2],
-            ]
-        )
-    return eList
+        events.append(featureToRecord(i))
+    return events
 
 
 def loadHeaderInfo(JSONData):
-    logging.debug(f"")
     return {
         "timeStamp": JSONData["metadata"]["generated"],
         "url": JSONData["metadata"]["url"],
@@ -0,0 +1,141 @@
+"""
+Description: Narrower summary feeds made from a wider cached one
+
+Every summary feed is a magnitude level and a time period, and most are
+a subset of another: 4.5_day holds the events of 2.5_week that are
+magnitude 4.5 or more and happened in the day before it was generated.
+When a wider feed in the cache was checked recently enough for the feed
+asked for, that feed is made by filtering the wider one instead of
+downloading it.  Significant feeds are the events with a significance
+(sig) of 600 or more, so they are only made from other significant
+feeds or from the "all" level.
+"""
+
+import time
+from collections import namedtuple
+
+from EarthquakeCache import (FEED_LEVELS, FEED_PERIODS, feedName, feedUrl,
+                             updateInterval)
+from EarthquakeData import FetchResult, getCache, getFileFeed
+from EarthquakeMetrics import metrics
+
+# Lowest magnitude in each level's feeds, None for no limit
+LEVEL_MAGNITUDE = {"4.5": 4.5, "2.5": 2.5, "1.0": 1.0, "all": None}
+# Lowest significance in the significant feeds
+SIGNIFICANT = 600
+PERIOD_MS = {
+    "hour": 3600 * 1000,
+    "day": 86400 * 1000,
+    "week": 7 * 86400 * 1000,
+    "month": 30 * 86400 * 1000,
+}
+# For the titles, as USGS words them
+LEVEL_TITLES = {"significant": "Significant", "all": "All"}
+PERIOD_TITLES = {"hour": "Hour", "day": "Day", "week": "Week",
+                 "month": "Month"}
+
+FeedParts = namedtuple("FeedParts", "level period")
+
+
+def feedParts(name):
+    # (level, period) of a summary feed name like 4.5_week, or None
+    level, _, period = name.partition("_")
+    if level not in FEED_LEVELS or period not in FEED_PERIODS:
+        return None
+    return FeedParts(level, period)
+
+
+def feedTitle(parts):
+    level = LEVEL_TITLES.get(parts.level, f"Magnitude {parts.level}+")
+    return f"USGS {level} Earthquakes, Past {PERIOD_TITLES[parts.period]}"
+
+
+def _holds(wider, narrower):
+    # True if every event of the narrower level is in the wider level
+    if narrower == "significant":
+        return wider in ("significant", "all")
+    if wider == "significant":
+        return False
+    low = LEVEL_MAGNITUDE[wider]
+    return low is None or low <= (LEVEL_MAGNITUDE[narrower] or 0)
+
+
+def supersets(name):
+    # Names of the other summary feeds that hold every event of a feed
+    parts = feedParts(name)
+    if parts is None:
+        return []
+    longer = FEED_PERIODS[FEED_PERIODS.index(parts.period):]
+    return [f"{level}_{period}"
+            for period in longer for level in FEED_LEVELS
+            if _holds(level, parts.level) and f"{level}_{period}" != name]
+
+
+def deriveRows(events, generated, parts):
+    # Rows of a wider feed's events that belong in the feed parts
+    since = generated - PERIOD_MS[parts.period]
+    times = events.time
+    rows = [r for r in range(len(events)) if times[r] >= since]
+    if parts.level == "significant":
+        sig = events.sig
+        return [r for r in rows if sig[r] >= SIGNIFICANT]
+    low = LEVEL_MAGNITUDE[parts.level]
+    if low is not None:
+        mag = events.mag
+        rows = [r for r in rows if mag[r] >= low]
+    return rows
+
+
+def deriveFeed(urlData, current=None, now=None):
+    # A summary feed made from a wider one in the cache, when one was
+    # generated by USGS within the update interval of the feed asked
+    # for and after any cached copy of the feed itself.  The smallest
+    # such feed is used.  When the wider feed has not changed since
+    # current (header, events) was made from it, current is returned.
+    # output: FetchResult like getWebFeed's, or None if the feed should
+    #         come from the cache or the web as usual
+    name = feedName(urlData)
+    parts = feedParts(name)
+    if parts is None:
+        return None
+    if now is None:
+        now = time.time()
+    cache = getCache()
+    with cache.lock:
+        if cache.isFresh(name, now):
+            return None
+        # when the wider feed was last checked says nothing about how
+        # old its events are, a month feed is only generated every 15
+        # minutes, so it goes by when USGS generated it (ms)
+        own = cache.index.get(name, {}).get("generated") or 0
+        oldest = max((now - updateInterval(name)) * 1000, own)
+        fresh = sorted((cache.index[wider]["size"], wider)
+                       for wider in supersets(name)
+                       if wider in cache.index
+                       and (cache.index[wider]["generated"] or 0) > oldest)
+    for _, wider in fresh:
+        # the feed being read is not the one the user is looking at,
+        # so its place in the LRU order is left alone
+        feed = getFileFeed(feedUrl(wider), use=False)
+        if feed is None:
+            continue
+        # but a cached copy of the feed asked for is, so it is still
+        # the one opened at the next start
+        cache.get(name)
+        header, events = feed
+        if (current is not None and current[0]["url"] == urlData
+                and current[0]["timeStamp"] == header["timeStamp"]):
+            metrics.count("derived_unchanged")
+            return FetchResult(current[0], current[1], None, 0, True)
+        with metrics.timer("derive"):
+            events = events.subset(
+                deriveRows(events, header["timeStamp"], parts))
+        metrics.count("derived_feeds")
+        header = {
+            "timeStamp": header["timeStamp"],
+            "url": urlData,
+            "title": feedTitle(parts),
+            "count": len(events),
+        }
+        return FetchResult(header, events, None, 0, True)
+    return None
@@ -0,0 +1,136 @@
+"""
+Description: Filtering events on time, magnitude, MMI, depth, alert and
+location
+
+Each numeric column gets a RangeIndex - its values sorted once with the
+matching rows - so the number of events in a range is found by binary
+search.  A filter starts from the criterion that matches the fewest
+events and checks the others only for those, instead of scanning the
+whole feed for every criterion.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from EarthquakeSpatial import SpatialIndex, distanceKm
+from EarthquakeStore import ALERTS
+
+# Filter criteria.  Any left as None are not used.
+#   since, until - event time, ms since the epoch
+#   minAlert - lowest alert level wanted, e.g. "orange" for orange+
+#   near - (lat, lon, km)
+#   box - (south, west, north, east)
+EventFilter = namedtuple(
+    "EventFilter",
+    "since until minMag maxMag minMmi maxMmi minDepth maxDepth minAlert "
+    "near box",
+    defaults=(None,) * 11)
+
+
+class RangeIndex:
+    def __init__(self, store, name):
+        self.rows = store.sortOrder((name,), reverse=False)
+        column = store.column(name)
+        self.values = [column[row] for row in self.rows]
+
+    def span(self, low=None, high=None):
+        # (start, end) of the part of self.rows with low <= value <= high
+        start = 0 if low is None else bisect_left(self.values, low)
+        end = (len(self.values) if high is None
+               else bisect_right(self.values, high))
+        return start, max(start, end)
+
+    def count(self, low=None, high=None):
+        start, end = self.span(low, high)
+        return end - start
+
+    def between(self, low=None, high=None):
+        start, end = self.span(low, high)
+        return self.rows[start:end]
+
+
+class FilterIndex:
+    # Range and spatial indexes for one version of an EventStore.  They
+    # are built the first time a filter needs them.
+    def __init__(self, store):
+        self.store = store
+        self._ranges = {}
+        self._spatial = None
+
+    def rangeIndex(self, name):
+        index = self._ranges.get(name)
+        if index is None:
+            index = self._ranges[name] = RangeIndex(self.store, name)
+        return index
+
+    def spatial(self):
+        if self._spatial is None:
+            self._spatial = SpatialIndex(self.store)
+        return self._spatial
+
+    def select(self, criteria):
+        # Rows matching all the criteria, or None if there are none
+        ranges = _ranges(criteria)
+        near, box = criteria.near, criteria.box
+        if not ranges and near is None and box is None:
+            return None
+        # start from whichever criterion matches the fewest events
+        best, name = None, None
+        if ranges:
+            best, name = min((self.rangeIndex(name).count(low, high), name)
+                             for name, low, high in ranges)
+        source = "range"
+        if near is not None:
+            nearRows = [row for _, row in self.spatial().withinRadius(*near)]
+            if best is None or len(nearRows) <= best:
+                source, best = "near", len(nearRows)
+        if box is not None:
+            boxRows = self.spatial().inBox(*box)
+            if best is None or len(boxRows) <= best:
+                source, best = "box", len(boxRows)
+        if source == "near":
+            candidates, near = nearRows, None
+        elif source == "box":
+            candidates, box = boxRows, None
+        else:
+            for n, (column, low, high) in enumerate(ranges):
+                if column == name:
+                    candidates = self.rangeIndex(name).between(low, high)
+                    del ranges[n]
+                    break
+        return self._check(candidates, ranges, near, box)
+
+    def _check(self, rows, ranges, near, box):
+        # keep the rows that pass every remaining criterion
+        store = self.store
+        for name, low, high in ranges:
+            rows = store.filterRows(name, low, high, rows)
+        lats, lons = store.lat, store.lon
+        if near is not None:
+            lat, lon, km = near
+            rows = [r for r in rows
+                    if distanceKm(lat, lon, lats[r], lons[r]) <= km]
+        if box is not None:
+            south, west, north, east = box
+            rows = [r for r in rows if south <= lats[r] <= north]
+            if west <= east:
+                rows = [r for r in rows if west <= lons[r] <= east]
+            else:
+                rows = [r for r in rows
+                        if lons[r] >= west or lons[r] <= east]
+        return list(rows)
+
+
+def _ranges(criteria):
+    # (column, low, high) for each range criterion that is set
+    alert = None
+    if criteria.minAlert:
+        alert = ALERTS.index(criteria.minAlert)
+    ranges = [
+        ("time", criteria.since, criteria.until),
+        ("mag", criteria.minMag, criteria.maxMag),
+        ("mmi", criteria.minMmi, criteria.maxMmi),
+        ("depth", criteria.minDepth, criteria.maxDepth),
+        ("alert", alert, None),
+    ]
+    return [r for r in ranges if r[1] is not None or r[2] is not None]
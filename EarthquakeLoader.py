@@ -0,0 +1,132 @@
+"""
+Description: Loads feeds on a worker thread for the GUI
+
+Tk must only be used from the main thread, so the worker never touches a
+widget.  It puts messages on a queue that the GUI empties from an
+after() callback.  Only the newest request matters: a new request
+cancels the one in progress and replaces any that has not started.
+Feeds fetched from the web are added to the event archive, if there is
+one, on the same thread.  A summary feed that can be made from a wider
+feed in the cache is made from it rather than downloaded.
+"""
+
+import queue
+import threading
+import time
+
+import logging
+
+from EarthquakeMetrics import metrics
+
+# Message kinds put on FeedLoader.results.  Every message is a tuple
+# (kind, generation, ...):
+#   (PROGRESS, generation, bytesRead, totalBytes)
+#   (DONE, generation, source, result, seconds)
+PROGRESS = "progress"
+DONE = "done"
+
+# Sources a request can be loaded from
+WEB = "web"
+FILE = "file"
+ARCHIVE = "archive"
+
+
+class FeedLoader:
+    # archive - EventArchive that new web feeds are added to (when
+    #           ingest is true) and ARCHIVE requests are read from
+    def __init__(self, archive=None):
+        self.archive = archive
+        self.ingest = archive is not None
+        self.results = queue.Queue()
+        self.generation = 0
+        self._wake = threading.Condition()
+        self._pending = None
+        self._cancel = None
+        self._thread = None
+
+    def request(self, source, urlData, current=None):
+        # Load a feed from WEB (getWebFeed) or FILE (getFileFeed), or
+        # query the ARCHIVE with current as the EventArchive.query
+        # arguments.
+        # output: the generation number the results will carry
+        with self._wake:
+            self.generation += 1
+            if self._cancel is not None:
+                self._cancel.set()
+            self._pending = (self.generation, source, urlData, current)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._worker, name="FeedLoader", daemon=True)
+                self._thread.start()
+            self._wake.notify()
+            return self.generation
+
+    def isCurrent(self, generation):
+        return generation == self.generation
+
+    def _worker(self):
+        while True:
+            with self._wake:
+                while self._pending is None:
+                    self._wake.wait()
+                generation, source, urlData, current = self._pending
+                self._pending = None
+                cancel = self._cancel = threading.Event()
+            self._load(generation, cancel, source, urlData, current)
+
+    def _load(self, generation, cancel, source, urlData, current):
+        # imported here, on the worker, so the window does not wait for
+        # urllib, ssl and gzip to load
+        from EarthquakeData import FetchCancelled, getFileFeed
+        from EarthquakeDerive import deriveFeed
+        lastReport = [0.0]
+
+        def progress(bytesRead, totalBytes):
+            if cancel.is_set():
+                raise FetchCancelled()
+            # a few updates a second is plenty for a progress bar
+            now = time.monotonic()
+            if now - lastReport[0] >= 0.1:
+                lastReport[0] = now
+                self.results.put((PROGRESS, generation, bytesRead,
+                                  totalBytes))
+
+        t1 = time.monotonic()
+        try:
+            if source == WEB:
+                # a feed made from a wider one needs no archiving, the
+                # wider one was archived when it was fetched
+                result = deriveFeed(urlData, current)
+                if result is None:
+                    result = self._fetch(urlData, current, progress)
+            elif source == ARCHIVE:
+                events = self.archive.query(**(current or {}))
+                result = (self.archive.header(events), events)
+            else:
+                result = getFileFeed(urlData, progress)
+        except FetchCancelled:
+            logging.debug(f"cancelled {urlData}")
+            return
+        except Exception:
+            logging.exception(f"Error loading {urlData}")
+            result = None
+        if not cancel.is_set():
+            self.results.put((DONE, generation, source, result,
+                              time.monotonic() - t1))
+
+    def _fetch(self, urlData, current, progress):
+        from EarthquakeData import getWebFeed
+        result = getWebFeed(urlData, current, progress)
+        # the archive skips events it already has, so every feed but
+        # the one already on screen is given to it
+        if (result and self.ingest and (
+                current is None or result.events is not current[1])):
+            # a feed that downloaded is still shown if the archive
+            # cannot take it, such as while another program has the
+            # database locked
+            try:
+                with metrics.timer("archive"):
+                    self.archive.ingest(result.events)
+            except Exception:
+                logging.exception(f"Error archiving {urlData}")
+        return result
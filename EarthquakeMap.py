@@ -0,0 +1,260 @@
+"""
+Description: Map of the events in a feed, drawn in bins
+
+Drawing a month of events one oval each is too slow to pan or zoom, so
+the map is drawn in bins of BIN_PX pixels.  The bins of a zoom level
+are worked out once per version of the data, the first time the level
+is shown: in one pass over the events, or by merging four bins of the
+level inside it when that has been made already.  They are grouped in
+square tiles, and only the tiles in the window are drawn.  Panning
+moves what is drawn and adds the tiles that come into view; zooming
+draws the new level's tiles.
+
+The projection is equirectangular, the world being 2 * WORLD_PX by
+WORLD_PX pixels at zoom 0 and twice that at each zoom in.
+"""
+
+import math
+from tkinter import Canvas, ttk
+
+WORLD_PX = 256
+MAX_ZOOM = 7
+# Size of a bin on screen, and the bins along a side of a tile
+BIN_PX = 16
+TILE_BINS = 16
+TILE_PX = BIN_PX * TILE_BINS
+# Degrees between the grid lines drawn under the events
+GRATICULE = 30
+# (lowest magnitude, colour) for the largest event in a bin
+MAG_COLOURS = ((6.0, "#c00000"), (4.5, "#ff7f00"), (2.5, "#e0c000"),
+               (float("-inf"), "#40a060"))
+
+
+def _binDegrees(zoom):
+    return 180 / (WORLD_PX << zoom) * BIN_PX
+
+
+def binEvents(events, zoom):
+    # The bins of one zoom level.  A bin is [count, largest magnitude,
+    # row of the largest, sum of latitudes, sum of longitudes].
+    # output: {(bx, by): bin}
+    degrees = _binDegrees(zoom)
+    columns, rows = int(round(360 / degrees)), int(round(180 / degrees))
+    bins = {}
+    mags, lats, lons = events.mag, events.lat, events.lon
+    for row in range(len(events)):
+        lat, lon, mag = lats[row], lons[row], mags[row]
+        key = (min(columns - 1, max(0, int((lon + 180) / degrees))),
+               min(rows - 1, max(0, int((90 - lat) / degrees))))
+        found = bins.get(key)
+        if found is None:
+            bins[key] = [1, mag, row, lat, lon]
+        else:
+            found[0] += 1
+            if mag > found[1]:
+                found[1], found[2] = mag, row
+            found[3] += lat
+            found[4] += lon
+    return bins
+
+
+def mergeBins(finer):
+    # The bins of the next zoom level out, four bins of finer to each
+    bins = {}
+    for (bx, by), (count, mag, row, sumLat, sumLon) in finer.items():
+        key = (bx >> 1, by >> 1)
+        found = bins.get(key)
+        if found is None:
+            bins[key] = [count, mag, row, sumLat, sumLon]
+        else:
+            found[0] += count
+            if mag > found[1]:
+                found[1], found[2] = mag, row
+            found[3] += sumLat
+            found[4] += sumLon
+    return bins
+
+
+def tileBins(bins):
+    # The bins of a level grouped by tile
+    # output: {(tx, ty): [(bx, by), ...]}
+    tiles = {}
+    for bx, by in bins:
+        tiles.setdefault((bx // TILE_BINS, by // TILE_BINS), []).append(
+            (bx, by))
+    return tiles
+
+
+class MapBins:
+    # The bins and tiles of each zoom level for one version of the
+    # events, kept with Dataset.cached.  A level is made the first time
+    # it is drawn, from the level inside it if that has been made.
+    def __init__(self, events):
+        self.events = events
+        self._levels = {}
+
+    def level(self, zoom):
+        # output: (bins, tiles)
+        found = self._levels.get(zoom)
+        if found is None:
+            finer = self._levels.get(zoom + 1)
+            if finer is not None:
+                bins = mergeBins(finer[0])
+            else:
+                bins = binEvents(self.events, zoom)
+            found = self._levels[zoom] = (bins, tileBins(bins))
+        return found
+
+
+class MapView(ttk.Frame):
+    # onPick(box, eventId) is called when a bin is clicked, with the
+    # bin's (south, west, north, east) and its largest event
+    def __init__(self, parent, onPick=None, width=2 * WORLD_PX + 64,
+                 height=WORLD_PX + 64):
+        super().__init__(parent)
+        self.onPick = onPick
+        self.canvas = Canvas(self, width=width, height=height,
+                             background="#f4f4f0", highlightthickness=0)
+        self.canvas.grid(column=0, row=0, sticky="NSEW")
+        self.info = ttk.Label(
+            self, text="Scroll to zoom, drag to move, click a circle "
+                       "to show its events")
+        self.info.grid(column=0, row=1, sticky="W")
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.data = None
+        self.version = None
+        self.levels = None
+        self.zoom = 0
+        # world pixel at the top left of the canvas
+        self.x0 = -(width - 2 * WORLD_PX) // 2
+        self.y0 = -(height - WORLD_PX) // 2
+        self.drawn = set()
+        self._press = None
+        self._dragged = False
+        self.canvas.bind("<ButtonPress-1>", self._pressed)
+        self.canvas.bind("<B1-Motion>", self._drag)
+        self.canvas.bind("<ButtonRelease-1>", self._released)
+        self.canvas.bind("<MouseWheel>", lambda e: self._wheel(
+            e, 1 if e.delta > 0 else -1))
+        self.canvas.bind("<Button-4>", lambda e: self._wheel(e, 1))
+        self.canvas.bind("<Button-5>", lambda e: self._wheel(e, -1))
+        self.canvas.bind("<Configure>", lambda e: self._update())
+
+    def setData(self, data):
+        # Show a Dataset.  Nothing is redone while its version is the
+        # one already drawn.
+        if data is self.data and data.version == self.version:
+            return
+        self.data = data
+        self.version = data.version
+        self.levels = data.cached("map", MapBins)
+        self._redraw()
+
+    # ----- Drawing ----------------------------------------------------
+    def _worldSize(self):
+        return 2 * WORLD_PX << self.zoom, WORLD_PX << self.zoom
+
+    def _redraw(self):
+        self.canvas.delete("all")
+        self.drawn = set()
+        self._drawGraticule()
+        self._update()
+
+    def _drawGraticule(self):
+        width, height = self._worldSize()
+        x0, y0 = self.x0, self.y0
+        for lon in range(-180, 181, GRATICULE):
+            x = (lon + 180) / 360 * width - x0
+            self.canvas.create_line(x, -y0, x, height - y0, fill="#d0d0c8",
+                                    tags="grid")
+        for lat in range(-90, 91, GRATICULE):
+            y = (90 - lat) / 180 * height - y0
+            self.canvas.create_line(-x0, y, width - x0, y, fill="#d0d0c8",
+                                    tags="grid")
+
+    def _visibleTiles(self):
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        first = (self.x0 // TILE_PX, self.y0 // TILE_PX)
+        last = ((self.x0 + width) // TILE_PX, (self.y0 + height) // TILE_PX)
+        return {(tx, ty) for tx in range(first[0], last[0] + 1)
+                for ty in range(first[1], last[1] + 1)}
+
+    def _update(self):
+        # Draw the tiles that have come into view and delete the ones
+        # that have gone out of it
+        if self.levels is None:
+            return
+        level, tiles = self.levels.level(self.zoom)
+        visible = {tile for tile in self._visibleTiles() if tile in tiles}
+        for tile in self.drawn - visible:
+            self.canvas.delete(f"t{tile[0]}_{tile[1]}")
+        for tile in visible - self.drawn:
+            self._drawTile(tile, level, tiles[tile])
+        self.drawn = visible
+
+    def _drawTile(self, tile, level, keys):
+        width, height = self._worldSize()
+        tileTag = f"t{tile[0]}_{tile[1]}"
+        for key in keys:
+            count, mag, _, sumLat, sumLon = level[key]
+            x = (sumLon / count + 180) / 360 * width - self.x0
+            y = (90 - sumLat / count) / 180 * height - self.y0
+            r = min(BIN_PX * 0.75, 3 + 1.5 * math.log2(count))
+            colour = next(c for low, c in MAG_COLOURS if mag >= low)
+            self.canvas.create_oval(
+                x - r, y - r, x + r, y + r, fill=colour, outline="#404040",
+                tags=(tileTag, f"b{key[0]}_{key[1]}"))
+
+    # ----- Pan, zoom and pick -----------------------------------------
+    def _pressed(self, event):
+        self._press = (event.x, event.y)
+        self._dragged = False
+
+    def _drag(self, event):
+        if self._press is None:
+            return
+        dx, dy = event.x - self._press[0], event.y - self._press[1]
+        if not self._dragged and abs(dx) + abs(dy) < 4:
+            return
+        self._dragged = True
+        self._press = (event.x, event.y)
+        self.canvas.move("all", dx, dy)
+        self.x0 -= dx
+        self.y0 -= dy
+        self._update()
+
+    def _released(self, event):
+        if self._press is not None and not self._dragged:
+            self._pick(event.x, event.y)
+        self._press = None
+
+    def _wheel(self, event, step):
+        # zoom in or out keeping the point under the mouse still
+        zoom = max(0, min(MAX_ZOOM, self.zoom + step))
+        if zoom == self.zoom:
+            return
+        scale = 2 ** (zoom - self.zoom)
+        self.x0 = int((self.x0 + event.x) * scale - event.x)
+        self.y0 = int((self.y0 + event.y) * scale - event.y)
+        self.zoom = zoom
+        self._redraw()
+
+    def _pick(self, x, y):
+        if self.levels is None or self.onPick is None:
+            return
+        level = self.levels.level(self.zoom)[0]
+        for item in reversed(self.canvas.find_overlapping(x - 2, y - 2,
+                                                          x + 2, y + 2)):
+            for tag in self.canvas.gettags(item):
+                if tag.startswith("b"):
+                    bx, by = map(int, tag[1:].split("_"))
+                    self._pickBin(bx, by, level[(bx, by)])
+                    return
+
+    def _pickBin(self, bx, by, found):
+        degrees = _binDegrees(self.zoom)
+        west, north = bx * degrees - 180, 90 - by * degrees
+        box = (north - degrees, west, north, west + degrees)
+        self.onPick(box, self.data.events.ids[found[2]])
@@ -0,0 +1,194 @@
+"""
+Description: Timings and counters for each stage of loading a feed
+
+Stages (dns, connect, request, download, read, decode, extract, diff,
+sort, filter, widget) are timed with metrics.timer() or observe(),
+and counters such as cache hits and events loaded with metrics.count().
+metrics.data() gives everything as a dict, which can be written as
+JSON or Prometheus text to a file or served over HTTP.  Setting the
+environment variable EARTHQUAKE_METRICS to a file name (ending in .prom
+for Prometheus text) writes it after every load, and
+EARTHQUAKE_METRICS_PORT serves it on http://localhost:PORT/metrics.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import logging
+
+METRICS_ENV = "EARTHQUAKE_METRICS"
+METRICS_PORT_ENV = "EARTHQUAKE_METRICS_PORT"
+# Prefix for the Prometheus metric names
+PREFIX = "earthquake"
+
+
+class Metrics:
+    # Shared by every thread, so all changes are made under a lock
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        # stage: [count, total seconds, longest seconds]
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t1)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def data(self):
+        # Everything collected so far
+        with self.lock:
+            return self._data()
+
+    def _data(self):
+        return {
+            "stages": {
+                stage: {"count": c, "seconds": total, "max": longest}
+                for stage, (c, total, longest) in self.stages.items()},
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+        }
+
+    def take(self):
+        # data() and reset() in one step, to hand what a worker process
+        # collected back to the main one
+        with self.lock:
+            data = self._data()
+            self._clear()
+            return data
+
+    def merge(self, data):
+        # Add in what take() returned somewhere else
+        with self.lock:
+            for stage, s in data["stages"].items():
+                entry = self.stages.setdefault(stage, [0, 0.0, 0.0])
+                entry[0] += s["count"]
+                entry[1] += s["seconds"]
+                entry[2] = max(entry[2], s["max"])
+            for name, n in data["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.gauges.update(data["gauges"])
+
+    def toJson(self):
+        return json.dumps(self.data(), indent=1, sort_keys=True)
+
+    def toPrometheus(self):
+        # Prometheus text exposition format
+        data = self.data()
+        lines = []
+        if data["stages"]:
+            name = f"{PREFIX}_stage_seconds"
+            lines.append(f"# TYPE {name} summary")
+            for stage, s in sorted(data["stages"].items()):
+                lines.append(f'{name}_sum{{stage="{stage}"}} {s["seconds"]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {s["count"]}')
+            lines.append(f"# TYPE {name}_max gauge")
+            for stage, s in sorted(data["stages"].items()):
+                lines.append(f'{name}_max{{stage="{stage}"}} {s["max"]}')
+        for counter, n in sorted(data["counters"].items()):
+            lines.append(f"# TYPE {PREFIX}_{counter}_total counter")
+            lines.append(f"{PREFIX}_{counter}_total {n}")
+        for gauge, value in sorted(data["gauges"].items()):
+            lines.append(f"# TYPE {PREFIX}_{gauge} gauge")
+            lines.append(f"{PREFIX}_{gauge} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # Write to a file, as Prometheus text if it ends in .prom and
+        # JSON otherwise
+        text = self.toPrometheus() if path.endswith(".prom") else \
+            self.toJson()
+        partFile = f"{path}.{os.getpid()}.part"
+        try:
+            with open(partFile, "w") as f:
+                f.write(text)
+            os.replace(partFile, path)
+        except OSError:
+            logging.error(f"\nError writing metrics - {path}")
+
+    def serve(self, port, host="localhost"):
+        # Serve /metrics (Prometheus text) and /metrics.json from a
+        # daemon thread
+        # output: the server, shut it down to stop
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = owner.toPrometheus()
+                    kind = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, kind = owner.toJson(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", kind)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="Metrics",
+                         daemon=True).start()
+        return server
+
+
+# The metrics for this process
+metrics = Metrics()
+
+
+def dumpFromEnvironment():
+    # Write the metrics to the file named by EARTHQUAKE_METRICS, if set
+    path = os.environ.get(METRICS_ENV)
+    if path:
+        metrics.dump(path)
+
+
+def serveFromEnvironment():
+    # Serve the metrics on the port in EARTHQUAKE_METRICS_PORT, if set
+    port = os.environ.get(METRICS_PORT_ENV)
+    if not port:
+        return None
+    try:
+        return metrics.serve(int(port))
+    except (OSError, ValueError) as e:
+        logging.error(f"Cannot serve metrics on port {port} - {e}")
+        return None
@@ -0,0 +1,120 @@
+"""
+Description: Works out when to refresh each feed
+
+Each feed is polled about as often as USGS regenerates it (every minute
+for the hour, day and week feeds, every 15 minutes for the month ones).
+When a poll finds nothing new the interval grows, up to a limit, and it
+drops back as soon as something changes.  Every interval is made up to
+JITTER longer at random so feeds added together do not stay in step; it
+is never made shorter, which would poll while the copy just fetched is
+still fresh in the cache and find nothing new.  A feed that is already being
+fetched is not handed out again until done() is called for it.
+
+The scheduler does no waiting itself: nextDelay() says how long to wait
+and due() which feeds to fetch, so it can be driven by Tk's after() as
+well as by a loop that sleeps.
+"""
+
+import random
+import threading
+import time
+
+from EarthquakeCache import feedName, updateInterval
+
+# Interval multiplier for each poll in a row that finds nothing new
+BACKOFF = 1.5
+# The interval never grows past this many times the normal one
+MAX_BACKOFF = 8
+# Intervals are lengthened at random by up to this fraction
+JITTER = 0.1
+
+
+class RefreshScheduler:
+    def __init__(self, backoff=BACKOFF, maxBackoff=MAX_BACKOFF,
+                 jitter=JITTER, clock=time.monotonic, rand=random.random):
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.jitter = jitter
+        self.clock = clock
+        self.rand = rand
+        self.lock = threading.Lock()
+        # url: {"interval", "due", "unchanged", "busy"}
+        self.feeds = {}
+
+    def add(self, url, interval=None, now=False):
+        # Start polling a feed.  interval defaults to how often USGS
+        # updates it; now=True polls it straight away rather than after
+        # one interval.
+        with self.lock:
+            if url in self.feeds:
+                return
+            if interval is None:
+                interval = updateInterval(feedName(url))
+            feed = self.feeds[url] = {
+                "interval": interval,
+                "due": 0,
+                "unchanged": 0,
+                "busy": False,
+            }
+            feed["due"] = self.clock() if now else self._next(feed)
+
+    def clear(self):
+        with self.lock:
+            self.feeds.clear()
+
+    def urls(self):
+        with self.lock:
+            return list(self.feeds)
+
+    def _next(self, feed):
+        # when to poll next, after the backoff and with jitter
+        interval = feed["interval"] * min(
+            self.backoff ** feed["unchanged"], self.maxBackoff)
+        return self.clock() + interval * (1 + self.jitter * self.rand())
+
+    def due(self):
+        # Feeds to fetch now.  They are marked busy until done() or
+        # cancelled() is called for them.
+        now = self.clock()
+        with self.lock:
+            urls = [url for url, feed in self.feeds.items()
+                    if not feed["busy"] and feed["due"] <= now]
+            for url in urls:
+                self.feeds[url]["busy"] = True
+            return urls
+
+    def done(self, url, changed, asked=True):
+        # A fetch has finished.  changed is False when it found nothing
+        # new (or failed), which lengthens the interval.  asked is False
+        # when the feed came from the cache or another feed without
+        # asking USGS, which says nothing about whether USGS has
+        # anything new, so the interval is left as it is.
+        with self.lock:
+            feed = self.feeds.get(url)
+            if feed is None:
+                return
+            if changed:
+                feed["unchanged"] = 0
+            elif asked:
+                feed["unchanged"] += 1
+            feed["busy"] = False
+            feed["due"] = self._next(feed)
+
+    def cancelled(self, url):
+        # A fetch was given up before it finished; try again after the
+        # usual interval
+        with self.lock:
+            feed = self.feeds.get(url)
+            if feed is not None and feed["busy"]:
+                feed["busy"] = False
+                feed["due"] = self._next(feed)
+
+    def nextDelay(self):
+        # Seconds until a feed is due, 0 if one is due now, or None if
+        # there is nothing to wait for
+        with self.lock:
+            waiting = [feed["due"] for feed in self.feeds.values()
+                       if not feed["busy"]]
+        if not waiting:
+            return None
+        return max(0.0, min(waiting) - self.clock())
@@ -0,0 +1,177 @@
+"""
+Description: Binary snapshot of a parsed feed, for a fast start
+
+Reading a large feed means decoding all of its JSON and pulling every
+field out of every feature.  Once a feed has been parsed its EventStore
+is also written next to the cached JSON as a snapshot: a fixed header,
+each numeric column as fixed-width little-endian values, then the
+strings NUL-separated.  A snapshot is memory-mapped and its columns
+copied straight into arrays, so no JSON is parsed.  It records the size
+and modification time of the JSON it was made from and is ignored when
+they no longer match.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+import logging
+
+from EarthquakeStore import NUMERIC_COLUMNS, EventStore
+
+MAGIC = b"EQSNAP\r\n"
+# Change when the layout changes, so old snapshots are rebuilt
+SNAPSHOT_VERSION = 2
+
+# magic, version, count, JSON size, JSON mtime (ns), generated, then the
+# byte lengths of the id, place, url and header text sections
+_prefix = struct.Struct("<8sIIQqqQQQQ")
+
+# Numeric columns as stored: (name, typecode).  Widest first so every
+# column starts aligned to its own width.  Array type codes with the
+# same size on every platform are used for the file.
+_columns = (
+    ("mag", "d"),
+    ("mmi", "d"),
+    ("time", "q"),
+    ("lon", "d"),
+    ("lat", "d"),
+    ("depth", "d"),
+    ("updated", "q"),
+    ("felt", "i"),
+    ("tz", "i"),
+    ("sig", "i"),
+    ("alert", "b"),
+)
+
+_swap = sys.byteorder != "little"
+
+
+def _sourceStat(source):
+    # (size, mtime) of a path or an os.stat result
+    stat = source if isinstance(source, os.stat_result) else os.stat(source)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _text(strings):
+    # NUL-separated UTF-8.  None (a url that is the usual prefix plus
+    # the id) is written as an empty string.
+    data = "\0".join(s or "" for s in strings)
+    if data.count("\0") != max(0, len(strings) - 1):
+        raise ValueError("NUL in a string")
+    return data.encode("utf-8")
+
+
+def _strings(data, count):
+    if not count:
+        return []
+    strings = data.decode("utf-8").split("\0")
+    if len(strings) != count:
+        raise ValueError("wrong number of strings")
+    return strings
+
+
+def writeSnapshot(path, source, header, events):
+    # Write the snapshot of a feed parsed from the JSON file source.
+    # source may be the os.stat result of the file taken when it was
+    # read, so a file replaced since is not matched with old events.
+    # output: True if it was written
+    try:
+        size, mtime = _sourceStat(source)
+        ids = _text(events.ids)
+        places = _text(events.place)
+        urls = _text(events.url)
+        text = _text((header["url"], header["title"]))
+    except (OSError, ValueError) as e:
+        logging.debug(f"no snapshot for {path} - {e}")
+        return False
+    partFile = f"{path}.{os.getpid()}.part"
+    try:
+        with open(partFile, "wb") as f:
+            f.write(_prefix.pack(
+                MAGIC, SNAPSHOT_VERSION, len(events), size, mtime,
+                header["timeStamp"] or 0, len(ids), len(places), len(urls),
+                len(text)))
+            for name, typecode in _columns:
+                column = getattr(events, name)
+                if column.typecode != typecode:
+                    column = array(typecode, column)
+                if _swap:
+                    column = array(typecode, column)
+                    column.byteswap()
+                f.write(column.tobytes())
+            for data in (ids, places, urls, text):
+                f.write(data)
+        os.replace(partFile, path)
+    except OSError:
+        logging.error(f"\nError writing snapshot - {path}")
+        try:
+            os.remove(partFile)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def readSnapshot(path, sourcePath):
+    # The feed in a snapshot, if it is there and was made from the
+    # current sourcePath
+    # output: (header, EventStore) or None
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _readMapped(mm, sourcePath)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        logging.debug(f"bad snapshot {path} - {e}")
+        return None
+
+
+def _readMapped(mm, sourcePath):
+    (magic, version, count, size, mtime, generated, idsLength,
+     placeLength, urlLength, textLength) = _prefix.unpack_from(mm)
+    if magic != MAGIC or version != SNAPSHOT_VERSION:
+        return None
+    if (size, mtime) != _sourceStat(sourcePath):
+        return None
+    buf = memoryview(mm)
+    try:
+        events = EventStore()
+        offset = _prefix.size
+        for name, typecode in _columns:
+            column = array(typecode)
+            end = offset + count * column.itemsize
+            if end > len(mm):
+                raise ValueError("snapshot is cut short")
+            column.frombytes(buf[offset:end])
+            if _swap:
+                column.byteswap()
+            if typecode != NUMERIC_COLUMNS[name]:
+                column = array(NUMERIC_COLUMNS[name], column)
+            setattr(events, name, column)
+            offset = end
+        sections = []
+        for length in (idsLength, placeLength, urlLength, textLength):
+            if offset + length > len(mm):
+                raise ValueError("snapshot is cut short")
+            sections.append(bytes(buf[offset:offset + length]))
+            offset += length
+    finally:
+        # the map cannot be closed while a view of it is open
+        buf.release()
+    ids, places, urls, text = sections
+    events.ids = _strings(ids, count)
+    events.place = list(map(sys.intern, _strings(places, count)))
+    events.url = [url or None for url in _strings(urls, count)]
+    events.index = dict(zip(events.ids, range(count)))
+    url, title = _strings(text, 2)
+    header = {
+        "timeStamp": generated,
+        "url": url,
+        "title": title,
+        "count": count,
+    }
+    return header, events
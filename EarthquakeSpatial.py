@@ -0,0 +1,166 @@
+"""
+Description: Grid index over event locations
+
+Events are put in cells of a fixed size in degrees.  A radius or
+bounding box query only looks at the cells it overlaps, so the cost
+depends on the size of the area asked about, not on the size of the
+feed.  A RegionIndex does the opposite, for many circles and one
+point at a time.  Distances are great-circle (haversine) distances in
+km.
+"""
+
+import math
+from array import array
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# Cell size in degrees.  Small enough that a query near a few hundred
+# km looks at few events outside the area, large enough that there
+# are not many empty cells to step over.
+CELL_DEGREES = 2.0
+
+
+def distanceKm(lat1, lon1, lat2, lon2):
+    # great-circle distance between two points in degrees
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2)
+         * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _lonColumn(lon, cellDegrees, columns):
+    # 180 degrees goes in the last column rather than wrapping round
+    return max(0, min(columns - 1, int(math.floor((lon + 180)
+                                                  / cellDegrees))))
+
+
+def _lonCells(west, east, cellDegrees):
+    # cell columns covering west..east, going east across 180 degrees
+    # when west > east
+    columns = int(round(360 / cellDegrees))
+    first = _lonColumn(west, cellDegrees, columns)
+    last = _lonColumn(east, cellDegrees, columns)
+    if west <= east:
+        return range(first, last + 1)
+    if first <= last:
+        # both ends in the same column, so every column is covered
+        return range(columns)
+    return list(range(first, columns)) + list(range(last + 1))
+
+
+def radiusBox(lat, lon, km):
+    # Smallest (south, west, north, east) box holding every point within
+    # km of lat, lon.  west > east when it crosses 180 degrees.
+    latSpan = km / KM_PER_DEGREE
+    south, north = lat - latSpan, lat + latSpan
+    # how far the circle reaches east and west at its widest
+    angle = math.sin(km / EARTH_RADIUS_KM)
+    if (south <= -90 or north >= 90
+            or km / EARTH_RADIUS_KM >= math.pi / 2
+            or angle >= math.cos(math.radians(lat))):
+        return max(south, -90), -180, min(north, 90), 180
+    lonSpan = math.degrees(math.asin(angle / math.cos(math.radians(lat))))
+    return south, _wrap(lon - lonSpan), north, _wrap(lon + lonSpan)
+
+
+class SpatialIndex:
+    def __init__(self, store, cellDegrees=CELL_DEGREES, rows=None):
+        # rows - index only these rows of the store (default all)
+        self.store = store
+        self.cellDegrees = cellDegrees
+        self.columns = int(round(360 / cellDegrees))
+        self.cells = {}
+        lat, lon = store.lat, store.lon
+        if rows is None:
+            rows = range(len(store))
+        for row in rows:
+            cell = self._cell(lat[row], lon[row])
+            members = self.cells.get(cell)
+            if members is None:
+                members = self.cells[cell] = array("l")
+            members.append(row)
+
+    def _cell(self, lat, lon):
+        latCell = int(math.floor((lat + 90) / self.cellDegrees))
+        # the north pole goes in the last row
+        return (max(0, min(latCell, int(180 / self.cellDegrees) - 1)),
+                _lonColumn(lon, self.cellDegrees, self.columns))
+
+    def _latCells(self, south, north):
+        top = int(180 / self.cellDegrees) - 1
+        first = max(0, int(math.floor((south + 90) / self.cellDegrees)))
+        last = min(top, int(math.floor((north + 90) / self.cellDegrees)))
+        return range(first, last + 1)
+
+    def withinRadius(self, lat, lon, km):
+        # Rows within km of a point, nearest first
+        # output: list of (distance, row)
+        south, west, north, east = radiusBox(lat, lon, km)
+        lonColumns = _lonCells(west, east, self.cellDegrees)
+        found = []
+        lats, lons = self.store.lat, self.store.lon
+        for latCell in self._latCells(south, north):
+            for lonCell in lonColumns:
+                for row in self.cells.get((latCell, lonCell), ()):
+                    d = distanceKm(lat, lon, lats[row], lons[row])
+                    if d <= km:
+                        found.append((d, row))
+        found.sort()
+        return found
+
+    def inBox(self, south, west, north, east):
+        # Rows inside a bounding box.  west > east means the box
+        # crosses 180 degrees.
+        crosses = west > east
+        found = []
+        lats, lons = self.store.lat, self.store.lon
+        for latCell in self._latCells(south, north):
+            for lonCell in _lonCells(west, east, self.cellDegrees):
+                for row in self.cells.get((latCell, lonCell), ()):
+                    la, lo = lats[row], lons[row]
+                    if not south <= la <= north:
+                        continue
+                    if crosses:
+                        if lo >= west or lo <= east:
+                            found.append(row)
+                    elif west <= lo <= east:
+                        found.append(row)
+        return found
+
+
+class RegionIndex:
+    # Circles (lat, lon, km), each with a value, put in every cell their
+    # bounding box overlaps.  Finding the circles a point is in only
+    # looks at the point's own cell, however many circles there are.
+    def __init__(self, cellDegrees=CELL_DEGREES):
+        self.cellDegrees = cellDegrees
+        self.columns = int(round(360 / cellDegrees))
+        self.cells = {}
+
+    # the same cells as a SpatialIndex
+    _cell = SpatialIndex._cell
+    _latCells = SpatialIndex._latCells
+
+    def add(self, lat, lon, km, value):
+        south, west, north, east = radiusBox(lat, lon, km)
+        circle = (lat, lon, km, value)
+        for latCell in self._latCells(south, north):
+            for lonCell in _lonCells(west, east, self.cellDegrees):
+                self.cells.setdefault((latCell, lonCell), []).append(circle)
+
+    def containing(self, lat, lon):
+        # Circles the point is in
+        # output: list of (distance, value)
+        found = []
+        for cLat, cLon, km, value in self.cells.get(self._cell(lat, lon),
+                                                    ()):
+            d = distanceKm(cLat, cLon, lat, lon)
+            if d <= km:
+                found.append((d, value))
+        return found
+
+
+def _wrap(lon):
+    # longitude into -180..180
+    return (lon + 180) % 360 - 180
@@ -0,0 +1,373 @@
+"""
+Description: Column based store for the earthquake events in a feed
+
+Each attribute is held in its own typed array instead of one Python list
+per event, so a month of data takes a fraction of the memory and sorting
+or filtering only touches the columns it needs.
+"""
+
+import sys
+from array import array
+from collections import namedtuple
+
+# Same field order as the lists returned by EarthquakeData.loadList
+Event = namedtuple(
+    "Event",
+    "id mag place time tz url felt alert mmi lon lat depth updated sig")
+
+# Events that differ between two versions of a feed, as lists of ids
+Diff = namedtuple("Diff", "added updated removed")
+
+# Alert levels, lowest first.  The store keeps the position in this
+# tuple so sorting on alert sorts on severity.
+ALERTS = ("", "green", "yellow", "orange", "red")
+_alertCodes = {name: n for n, name in enumerate(ALERTS)}
+
+# Stored in the integer columns when the feed has a null
+NO_VALUE = -1
+
+# Event page urls are nearly always this prefix plus the event id, so
+# only the ones that are different are kept.
+URL_PREFIX = "https://earthquake.usgs.gov/earthquakes/eventpage/"
+
+# Sort orders by name, the columns to sort on (descending) most
+# significant first
+SORT_KEYS = {
+    "mag": ("mag", "alert"),
+    "mmi": ("mmi", "mag", "alert"),
+    "time": ("time",),
+    "depth": ("depth", "mag"),
+    "felt": ("felt", "mag"),
+}
+
+# Numeric columns and their array type codes
+NUMERIC_COLUMNS = {
+    "mag": "d",
+    "mmi": "d",
+    "time": "q",
+    "lon": "d",
+    "lat": "d",
+    "depth": "d",
+    "felt": "l",
+    "tz": "l",
+    "alert": "b",
+    "updated": "q",
+    "sig": "l",
+}
+
+
+class EventStore:
+    def __init__(self):
+        self.ids = []
+        self.place = []
+        self.url = []
+        for name, typecode in NUMERIC_COLUMNS.items():
+            setattr(self, name, array(typecode))
+        # row number for each event id
+        self.index = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (self.event(row) for row in range(len(self.ids)))
+
+    def append(self, record):
+        # record - one list in the loadList layout
+        eventId = record[0]
+        self.index[eventId] = len(self.ids)
+        self.ids.append(eventId)
+        self.mag.append(record[1] or 0.0)
+        place = record[2]
+        self.place.append(sys.intern(place) if place else "")
+        self.time.append(record[3] or 0)
+        self.tz.append(NO_VALUE if record[4] is None else record[4])
+        url = record[5]
+        self.url.append(None if url == URL_PREFIX + eventId else url)
+        self.felt.append(NO_VALUE if record[6] is None else record[6])
+        # an unknown level from USGS is ranked with no alert
+        self.alert.append(_alertCodes.get(record[7] or "", 0))
+        self.mmi.append(record[8] or 0.0)
+        self.lon.append(record[9])
+        self.lat.append(record[10])
+        self.depth.append(record[11] or 0.0)
+        # lists from before the updated time was kept have 12 fields
+        self.updated.append((record[12] or 0) if len(record) > 12 else 0)
+        # and before the significance was kept, 13
+        sig = record[13] if len(record) > 13 else None
+        self.sig.append(NO_VALUE if sig is None else sig)
+
+    # ----- Accessors --------------------------------------------------
+    def event(self, row):
+        return Event(
+            self.ids[row],
+            self.mag[row],
+            self.place[row],
+            self.time[row],
+            self.getTz(row),
+            self.getUrl(row),
+            self.getFelt(row),
+            ALERTS[self.alert[row]],
+            self.mmi[row],
+            self.lon[row],
+            self.lat[row],
+            self.depth[row],
+            self.updated[row],
+            self.getSig(row),
+        )
+
+    def getUrl(self, row):
+        url = self.url[row]
+        return URL_PREFIX + self.ids[row] if url is None else url
+
+    def getFelt(self, row):
+        felt = self.felt[row]
+        return None if felt == NO_VALUE else felt
+
+    def getTz(self, row):
+        tz = self.tz[row]
+        return None if tz == NO_VALUE else tz
+
+    def getSig(self, row):
+        sig = self.sig[row]
+        return None if sig == NO_VALUE else sig
+
+    def row(self, eventId):
+        # row number of an event id, or None if it is not in the store
+        return self.index.get(eventId)
+
+    def column(self, name):
+        return getattr(self, name)
+
+    # ----- Sorting, filtering and statistics --------------------------
+    def sortOrder(self, keys, reverse=True, rows=None):
+        # Rows ordered on the named columns, the first name being the
+        # most significant.  Python's sort is stable, so one pass per
+        # column from the least significant gives the same order as a
+        # tuple key without building a tuple per event.  Rows that tie
+        # on every column keep their order in rows.
+        # output: array of row numbers
+        order = list(range(len(self.ids)) if rows is None else rows)
+        for name in reversed(keys):
+            order.sort(key=self.column(name).__getitem__, reverse=reverse)
+        return array("l", order)
+
+    def filterRows(self, name, low=None, high=None, rows=None):
+        # Rows where low <= column <= high.  Either bound may be None.
+        col = self.column(name)
+        if rows is None:
+            rows = range(len(col))
+        if low is not None and high is not None:
+            return [r for r in rows if low <= col[r] <= high]
+        if low is not None:
+            return [r for r in rows if col[r] >= low]
+        if high is not None:
+            return [r for r in rows if col[r] <= high]
+        return list(rows)
+
+    def stats(self, name, rows=None):
+        # count, min, max and mean of a numeric column, leaving out the
+        # nulls of the integer columns
+        col = self.column(name)
+        values = col if rows is None else [col[r] for r in rows]
+        if col.typecode == "l":
+            values = [value for value in values if value != NO_VALUE]
+        if not values:
+            return {"count": 0, "min": None, "max": None, "mean": None}
+        return {
+            "count": len(values),
+            "min": min(values),
+            "max": max(values),
+            "mean": sum(values) / len(values),
+        }
+
+    def subset(self, rows):
+        # A new store holding only the given rows, in that order
+        new = EventStore()
+        new.ids = [self.ids[r] for r in rows]
+        new.place = [self.place[r] for r in rows]
+        new.url = [self.url[r] for r in rows]
+        for name, typecode in NUMERIC_COLUMNS.items():
+            col = self.column(name)
+            setattr(new, name, array(typecode, (col[r] for r in rows)))
+        new.index = {eventId: n for n, eventId in enumerate(new.ids)}
+        return new
+
+
+def diffStores(old, new):
+    # Compare two versions of a feed by event id.  An event counts as
+    # updated when USGS has changed its updated time.
+    # output: Diff of id lists
+    added = []
+    updated = []
+    oldIndex = old.index
+    oldUpdated = old.updated
+    newUpdated = new.updated
+    for row, eventId in enumerate(new.ids):
+        oldRow = oldIndex.get(eventId)
+        if oldRow is None:
+            added.append(eventId)
+        elif newUpdated[row] != oldUpdated[oldRow]:
+            updated.append(eventId)
+    newIndex = new.index
+    removed = [eventId for eventId in old.ids if eventId not in newIndex]
+    return Diff(added, updated, removed)
+
+
+def rowMap(old, new):
+    # Row in new of each row of old, -1 for events new does not have
+    index = new.index
+    return [index.get(eventId, -1) for eventId in old.ids]
+
+
+class SortedView:
+    # The events of a store in descending order of the given columns,
+    # ties in ascending order of event id.  The order is an array of row
+    # numbers, 8 bytes an event.  A Diff is applied by finding the events
+    # that move with a binary search and splicing them in, rather than
+    # sorting everything again.
+    def __init__(self, store, columns):
+        self.store = store
+        self.columns = tuple(columns)
+        byId = sorted(range(len(store)), key=store.ids.__getitem__)
+        self.order = store.sortOrder(self.columns, rows=byId)
+
+    def _key(self, store, row):
+        # columns are negated so the order is ascending in the key.  Only
+        # made for the few rows a search looks at.
+        return tuple(
+            [-store.column(name)[row] for name in self.columns]
+            + [store.ids[row]])
+
+    def _bisect(self, key):
+        # first position in the order whose key is not below key
+        store, order = self.store, self.order
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(store, order[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __len__(self):
+        return len(self.order)
+
+    def eventId(self, n):
+        return self.store.ids[self.order[n]]
+
+    def row(self, n):
+        # row in the store for position n of the view
+        return self.order[n]
+
+    def rows(self):
+        return self.order
+
+    def position(self, eventId):
+        # position of an event in the view, or None
+        row = self.store.index.get(eventId)
+        if row is None:
+            return None
+        n = self._bisect(self._key(self.store, row))
+        if n == len(self.order) or self.order[n] != row:
+            # not in a FilteredView
+            return None
+        return n
+
+    def apply(self, diff, store, moved=None):
+        # Move the view on to a new version of the store.  Only the
+        # events in the diff are searched for; the rest of the order is
+        # copied in slices and renumbered with moved, rowMap(old store,
+        # store), which is worked out here if not given.
+        old = self.store
+        gone = sorted(self._bisect(self._key(old, old.index[eventId]))
+                      for eventId in diff.removed + diff.updated)
+        kept = _splice(self.order, [(n, n + 1, None) for n in gone])
+        if moved is None:
+            moved = rowMap(old, store)
+        self.store = store
+        self.order = array("l", [moved[row] for row in kept])
+        index = store.index
+        added = sorted((self._key(store, index[eventId]), index[eventId])
+                       for eventId in diff.added + diff.updated)
+        # positions in the order without any of the added events, which
+        # come out in order as the added events are sorted
+        inserts = [(self._bisect(key), row) for key, row in added]
+        self.order = _splice(self.order,
+                             [(n, n, row) for n, row in inserts])
+
+
+def _splice(order, edits):
+    # A copy of order with each (start, end, row) edit, in order of
+    # start, replacing order[start:end] with row (or nothing if None)
+    result = array("l")
+    done = 0
+    for start, end, row in edits:
+        result += order[done:start]
+        if row is not None:
+            result.append(row)
+        done = end
+    result += order[done:]
+    return result
+
+
+class FilteredView(SortedView):
+    # A SortedView of only some rows of the store, in the same order
+    def __init__(self, view, rows):
+        self.store = view.store
+        self.columns = view.columns
+        if len(rows) * 16 < len(view):
+            # few enough to sort by key
+            self.order = array("l", sorted(
+                rows, key=lambda row: self._key(self.store, row)))
+        else:
+            wanted = bytearray(len(self.store))
+            for row in rows:
+                wanted[row] = 1
+            self.order = array("l", [row for row in view.order
+                                     if wanted[row]])
+
+
+class Dataset:
+    # One feed held in memory: its header, the event store and a
+    # SortedView for each sort order used so far.  A view is built the
+    # first time it is asked for and then kept up to date by update(),
+    # so changing the sort order is only a lookup.  version goes up by
+    # one every time the events change.
+    def __init__(self, header, events):
+        self.header = header
+        self.events = events
+        self.version = 1
+        self.views = {}
+        self._cache = {}
+
+    def view(self, sortName):
+        view = self.views.get(sortName)
+        if view is None:
+            view = SortedView(self.events, SORT_KEYS[sortName])
+            self.views[sortName] = view
+        return view
+
+    def update(self, header, events):
+        # Move on to a new version of the feed
+        # output: Diff against the previous version
+        diff = diffStores(self.events, events)
+        self.header = header
+        if not (diff.added or diff.updated or diff.removed):
+            # nothing changed, keep the store the views point at
+            return diff
+        moved = rowMap(self.events, events) if self.views else None
+        for view in self.views.values():
+            view.apply(diff, events, moved)
+        self.events = events
+        self.version += 1
+        return diff
+
+    def cached(self, name, build):
+        # Something worked out from the events, such as an index, kept
+        # until the events change.  build(events) makes it.
+        entry = self._cache.get(name)
+        if entry is None or entry[0] != self.version:
+            entry = self._cache[name] = (self.version, build(self.events))
+        return entry[1]
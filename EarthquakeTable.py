@@ -0,0 +1,183 @@
+"""
+Description: Scrolling table of events that only draws the rows on screen
+
+A ttk.Treeview with a few hundred thousand items is slow to fill and to
+scroll, so the table keeps a fixed set of Treeview rows and fills them
+from the current position in a sorted view each time it moves.  Only
+the visible rows are ever formatted, all of them in one call.
+"""
+
+from tkinter import ttk
+
+# (name, heading, width in pixels, anchor) for the table columns.  The
+# name is also the sort order asked for when the heading is clicked.
+COLUMNS = (
+    ("mag", "Mag", 50, "e"),
+    ("mmi", "MMI", 60, "e"),
+    ("alert", "Alert", 60, "w"),
+    ("felt", "Felt", 50, "e"),
+    ("depth", "Depth km", 70, "e"),
+    ("time", "Local time", 170, "w"),
+    ("ago", "Age", 130, "w"),
+    ("place", "Place", 380, "w"),
+)
+
+# Events fired on the table frame
+SELECTED = "<<EventSelected>>"
+
+
+class EventTable(ttk.Frame):
+    # view - anything with __len__, eventId(n) and row(n), normally a
+    #        SortedView
+    # formatRows(rows) - returns a list of (values, tags), one for each
+    #        of a list of rows of the store
+    # onSort(name) - called with the column name when a heading is
+    #        clicked
+    def __init__(self, parent, height=12, columns=COLUMNS, onSort=None):
+        super().__init__(parent)
+        self.height = height
+        self.onSort = onSort
+        self.view = None
+        self.formatRows = None
+        self.offset = 0
+        self.selected = None
+        self.tree = ttk.Treeview(
+            self, height=height, show="headings", selectmode="browse",
+            columns=[c[0] for c in columns])
+        for name, heading, width, anchor in columns:
+            self.tree.heading(name, text=heading,
+                              command=lambda n=name: self._sortBy(n))
+            self.tree.column(name, width=width, anchor=anchor,
+                             stretch=(name == "place"))
+        self.tree.tag_configure("new", foreground="red")
+        self.iids = [self.tree.insert("", "end", values=())
+                     for _ in range(height)]
+        self.scroll = ttk.Scrollbar(self, orient="vertical",
+                                    command=self.yview)
+        self.tree.grid(column=0, row=0, sticky="NSEW")
+        self.scroll.grid(column=1, row=0, sticky="NS")
+        self.columnconfigure(0, weight=1)
+        self.tree.bind("<<TreeviewSelect>>", self._click)
+        for key, handler in (
+                ("<Up>", lambda e: self.move(-1)),
+                ("<Down>", lambda e: self.move(1)),
+                ("<Prior>", lambda e: self.move(-self.height)),
+                ("<Next>", lambda e: self.move(self.height)),
+                ("<Home>", lambda e: self.moveTo(0)),
+                ("<End>", lambda e: self.moveTo(self._last()))):
+            self.tree.bind(key, lambda e, h=handler: h(e) or "break")
+        for widget in (self.tree, self.scroll):
+            widget.bind("<MouseWheel>", self._wheel)
+            widget.bind("<Button-4>", lambda e: self.yview("scroll", -3,
+                                                           "units"))
+            widget.bind("<Button-5>", lambda e: self.yview("scroll", 3,
+                                                           "units"))
+
+    def setData(self, view, formatRows, selected=None):
+        # Show a (new) view.  selected is an event id to keep selected,
+        # otherwise the first event is.
+        self.view = view
+        self.formatRows = formatRows
+        n = None if selected is None else view.position(selected)
+        if n is None:
+            n = 0 if len(view) else None
+        self.selected = n
+        if n is not None and not (
+                self.offset <= n < self.offset + self.height):
+            self.offset = n - self.height // 2
+        self._render()
+        self.event_generate(SELECTED)
+
+    def refresh(self):
+        # Format the rows on screen again, e.g. for the ages in them
+        if self.view is not None:
+            self._render()
+
+    def selectedId(self):
+        if self.selected is None:
+            return None
+        return self.view.eventId(self.selected)
+
+    def selectedRow(self):
+        # row in the store of the selected event, or None
+        if self.selected is None:
+            return None
+        return self.view.row(self.selected)
+
+    def move(self, step):
+        if self.selected is not None:
+            self.moveTo(self.selected + step)
+
+    def moveTo(self, n):
+        # select position n, scrolling it into view
+        if not self.view:
+            return
+        n = max(0, min(n, len(self.view) - 1))
+        if n == self.selected:
+            return
+        self.selected = n
+        if n < self.offset:
+            self.offset = n
+        elif n >= self.offset + self.height:
+            self.offset = n - self.height + 1
+        self._render()
+        self.event_generate(SELECTED)
+
+    def _last(self):
+        return len(self.view) - 1 if self.view is not None else 0
+
+    def yview(self, *args):
+        # Scrollbar and mouse wheel.  Scrolling does not change the
+        # selection.
+        if not self.view:
+            return
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.view))
+        elif args[0] == "scroll":
+            step = self.height if args[2] == "pages" else 1
+            self.offset += int(args[1]) * step
+        self._render()
+
+    def _wheel(self, event):
+        self.yview("scroll", -1 if event.delta > 0 else 1, "units")
+
+    def _sortBy(self, name):
+        if self.onSort is not None:
+            self.onSort(name)
+
+    def _click(self, event):
+        for n, iid in enumerate(self.iids):
+            if iid in self.tree.selection():
+                position = self.offset + n
+                if position != self.selected and position < len(self.view):
+                    self.selected = position
+                    self.event_generate(SELECTED)
+                break
+
+    def _render(self):
+        # Fill the Treeview rows from the current offset.  This is the
+        # only place rows are formatted.
+        total = len(self.view) if self.view is not None else 0
+        self.offset = max(0, min(self.offset, total - self.height))
+        end = min(total, self.offset + self.height)
+        formatted = self.formatRows(
+            [self.view.row(p) for p in range(self.offset, end)])
+        selectIid = None
+        for n, iid in enumerate(self.iids):
+            position = self.offset + n
+            if position < total:
+                values, tags = formatted[n]
+                self.tree.item(iid, values=values, tags=tags)
+                if position == self.selected:
+                    selectIid = iid
+            else:
+                self.tree.item(iid, values=(), tags=())
+        if selectIid is None:
+            self.tree.selection_remove(self.tree.selection())
+        elif self.tree.selection() != (selectIid,):
+            self.tree.selection_set(selectIid)
+        if total:
+            self.scroll.set(self.offset / total,
+                            min(1.0, (self.offset + self.height) / total))
+        else:
+            self.scroll.set(0.0, 1.0)
@@ -0,0 +1,109 @@
+"""
+Description: Formatting event times for display
+
+Looking up the local time zone and converting with it for every event
+shown is slow once the table has a time column.  The local zone is
+found once, and a TimeFormatter works out a zone's UTC offset and name
+only once per hour of UTC time.  After that a time is formatted with
+integer arithmetic and a cached date string, for a whole list of times
+at once.  Only the hours in which the zone changes its offset are
+converted one time at a time.  The relative ages ("about 5 minutes
+ago") are formatted the same way, against one "now" per batch.
+"""
+
+import time
+from datetime import date, datetime, timezone
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+# Length of the blocks of time the zone offset is cached for (seconds)
+OFFSET_STEP = 3600
+
+_localZone = None
+
+
+def localZone():
+    # The computer's time zone, looked up the first time it is needed
+    global _localZone
+    if _localZone is None:
+        from tzlocal import get_localzone
+        _localZone = get_localzone()
+    return _localZone
+
+
+def ago(ms, now=None):
+    # How long ago a time (ms since the epoch) was, rounded to minutes,
+    # hours or days
+    if now is None:
+        now = time.time()
+    seconds = now - ms / 1000
+    hours = seconds / 3600
+    if hours > 48:
+        return f"about {hours / 24:.0f} days ago"
+    elif hours >= 2:
+        return f"about {hours:.0f} hours ago"
+    elif seconds > 90:
+        return f"about {seconds / 60:.0f} minutes ago"
+    else:
+        return "about a minute ago"
+
+
+def agoAll(times, now=None):
+    # ago() for a list of times, all against the same now
+    if now is None:
+        now = time.time()
+    return [ago(ms, now) for ms in times]
+
+
+class TimeFormatter:
+    # Formats ms since the epoch as "YYYY-MM-DD HH:MM:SS ZONE" in one
+    # zone, UTC by default
+    def __init__(self, zone=timezone.utc):
+        self.zone = zone
+        # hour since the epoch: (offset in seconds, zone name), or None
+        # if the offset changes during the hour
+        self._offsets = {}
+        # days since the epoch: "YYYY-MM-DD"
+        self._days = {}
+
+    def _offset(self, step):
+        if step in self._offsets:
+            return self._offsets[step]
+        first, last = (self._exact(step * OFFSET_STEP + s)
+                       for s in (0, OFFSET_STEP - 1))
+        found = self._offsets[step] = first if first == last else None
+        return found
+
+    def _exact(self, seconds):
+        local = datetime.fromtimestamp(seconds, self.zone)
+        return int(local.utcoffset().total_seconds()), local.tzname()
+
+    def _day(self, day):
+        text = self._days.get(day)
+        if text is None:
+            text = self._days[day] = date.fromordinal(
+                EPOCH_ORDINAL + day).isoformat()
+        return text
+
+    def format(self, ms):
+        seconds = ms // 1000
+        found = self._offset(seconds // OFFSET_STEP)
+        offset, name = found if found else self._exact(seconds)
+        day, rest = divmod(seconds + offset, 86400)
+        return (f"{self._day(day)} {rest // 3600:02d}:"
+                f"{rest // 60 % 60:02d}:{rest % 60:02d} {name}")
+
+    def formatAll(self, times):
+        # format() for a list of times
+        return [self.format(int(ms)) for ms in times]
+
+
+_formatters = {}
+
+
+def formatter(local=False):
+    # The shared TimeFormatter for UTC or the local zone
+    zone = localZone() if local else timezone.utc
+    found = _formatters.get(local)
+    if found is None or found.zone is not zone:
+        found = _formatters[local] = TimeFormatter(zone)
+    return found
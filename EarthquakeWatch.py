@@ -0,0 +1,176 @@
+"""
+Description: Standing queries checked against every refresh
+
+A watch is a set of criteria, such as "magnitude 4.5 or more within 300
+km of any of these sites" or "orange alert or above".  Watches are read
+from a JSON file:
+
+    [
+        {"name": "Plants", "minMag": 4.5, "km": 300,
+         "sites": [{"name": "Plant A", "lat": 35.1, "lon": -120.6}]},
+        {"name": "Alerts", "minAlert": "orange"}
+    ]
+
+Only the events a refresh added or updated are checked.  Every site is
+put in a RegionIndex, so an event is only compared with the sites near
+it rather than with every site of every watch.  Each match is notified
+once; a later revision of the event notifies again only if its alert
+level has gone up.
+"""
+
+import json
+import os
+from collections import namedtuple
+
+import logging
+
+from EarthquakeMetrics import metrics
+from EarthquakeSpatial import RegionIndex
+from EarthquakeStore import ALERTS
+
+WatchFile = 'earthquake_watches.json'
+WATCHES_ENV = "EARTHQUAKE_WATCHES"
+# Events are forgotten this long after they happened, no feed holds
+# them after that (ms)
+FORGET_MS = 31 * 86400 * 1000
+
+# minAlert is the lowest alert level wanted.  An event must be within
+# km of one of the sites, if there are any.
+Watch = namedtuple("Watch", "name minMag minMmi minAlert sites km",
+                   defaults=(None, None, None, (), None))
+Site = namedtuple("Site", "name lat lon")
+# site and distance are None for a watch with no sites
+Match = namedtuple("Match", "watch event site distance")
+
+
+def loadWatches(path=None):
+    # Watches from a JSON file, by default the one named by
+    # EARTHQUAKE_WATCHES or else WatchFile.  No file means no watches.
+    # output: list of Watch
+    if path is None:
+        path = os.environ.get(WATCHES_ENV, WatchFile)
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError):
+        logging.error(f"\nError reading watches - {path}")
+        return []
+    watches = []
+    for n, entry in enumerate(data):
+        try:
+            sites = tuple(Site(site.get("name", f"{site['lat']},"
+                                                f"{site['lon']}"),
+                               float(site["lat"]), float(site["lon"]))
+                          for site in entry.get("sites", ()))
+            watch = Watch(
+                name=entry.get("name", f"watch {n + 1}"),
+                minMag=entry.get("minMag"),
+                minMmi=entry.get("minMmi"),
+                minAlert=entry.get("minAlert"),
+                sites=sites,
+                km=entry.get("km"))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            logging.error(f"\nBad watch {n + 1} in {path}")
+            continue
+        if watch.minAlert is not None and watch.minAlert not in ALERTS:
+            logging.error(f"\nBad alert level in watch {watch.name}")
+            continue
+        if sites and not watch.km:
+            logging.error(f"\nWatch {watch.name} has sites but no km")
+            continue
+        watches.append(watch)
+    return watches
+
+
+def describe(match):
+    # One line about a match, for a log or a message box
+    event = match.event
+    text = f"{match.watch.name}: M {event.mag:.1f} {event.place}"
+    if match.site is not None:
+        text += f", {match.distance:,.0f} km from {match.site.name}"
+    if event.alert:
+        text += f", {event.alert} alert"
+    return text
+
+
+def logMatch(match):
+    logging.warning(describe(match))
+
+
+class WatchList:
+    # notify(match) is called for each new match
+    def __init__(self, watches=(), notify=logMatch):
+        self.notify = notify
+        self.watches = []
+        self._anywhere = []
+        self._sites = RegionIndex()
+        # (watch name, event id, site name): (alert code, event time)
+        self._notified = {}
+        for watch in watches:
+            self.add(watch)
+
+    def __len__(self):
+        return len(self.watches)
+
+    def add(self, watch):
+        self.watches.append(watch)
+        if not watch.sites:
+            self._anywhere.append(watch)
+        for site in watch.sites:
+            self._sites.add(site.lat, site.lon, watch.km, (watch, site))
+
+    def matches(self, events, ids=None):
+        # Matches for the events with the given ids, every event if None
+        mags, mmis, alerts = events.mag, events.mmi, events.alert
+        rows = range(len(events)) if ids is None else (
+            events.row(eventId) for eventId in ids)
+        for row in rows:
+            candidates = [(None, (watch, None)) for watch in self._anywhere]
+            candidates += self._sites.containing(events.lat[row],
+                                                 events.lon[row])
+            for distance, (watch, site) in candidates:
+                if watch.minMag is not None and mags[row] < watch.minMag:
+                    continue
+                if watch.minMmi is not None and mmis[row] < watch.minMmi:
+                    continue
+                if (watch.minAlert is not None
+                        and alerts[row] < ALERTS.index(watch.minAlert)):
+                    continue
+                yield Match(watch, events.event(row), site, distance)
+
+    def check(self, events, ids=None):
+        # Notify the matches for the events with the given ids (every
+        # event if None) that have not been notified before
+        # output: list of the new matches
+        if not self.watches:
+            return []
+        new = []
+        with metrics.timer("watch"):
+            for match in self.matches(events, ids):
+                event = match.event
+                key = (match.watch.name, event.id,
+                       None if match.site is None else match.site.name)
+                alert = ALERTS.index(event.alert)
+                seen = self._notified.get(key)
+                if seen is not None and seen[0] >= alert:
+                    metrics.count("watch_repeats")
+                    continue
+                self._notified[key] = (alert, event.time)
+                new.append(match)
+            self._forget(events)
+        metrics.count("watch_matches", len(new))
+        if self.notify is not None:
+            for match in new:
+                self.notify(match)
+        return new
+
+    def _forget(self, events):
+        # drop events too old to be in any feed, so a watch running for
+        # months does not keep every match
+        if not events or len(self._notified) < 1000:
+            return
+        newest = max(events.time)
+        self._notified = {key: seen for key, seen in self._notified.items()
+                          if seen[1] >= newest - FORGET_MS}
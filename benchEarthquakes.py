@@ -0,0 +1,298 @@
+"""
+Description: Benchmarks for loading, sorting and showing large feeds
+
+Writes synthetic feeds in the USGS summary GeoJSON layout (with the
+nulls the real feeds have in mag, mmi, alert, felt and tz) and times
+each step the GUI goes through, with no display needed.  Every step is
+timed on its own and then run again under tracemalloc for its peak
+memory.  The results can be saved as a JSON baseline; later runs are
+compared with it and fail when a step is slower or bigger by more than
+the tolerance.
+
+    python benchEarthquakes.py --save
+    python benchEarthquakes.py --sizes 1000 10000
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import logging
+
+import EarthquakeData
+from EarthquakeCache import FeedCache
+from EarthquakeData import (getDataFile, getFileFeed, loadHeaderInfo,
+                            loadList, loadStore)
+from EarthquakeStore import SORT_KEYS, Dataset
+from guiEarthquakes import EarthquakeGUI
+
+SIZES = (1000, 10000, 100000, 1000000)
+BaselineFile = 'benchmark_baseline.json'
+# A step fails when it is this much slower or bigger than the baseline
+TOLERANCE = 0.5
+# Times under this are too noisy to compare (seconds)
+MIN_SECONDS = 0.005
+# Peaks under this are too small to compare, one step allocating a
+# few buffers more is not a regression (bytes)
+MIN_BYTES = 256 * 1024
+# Rows formatted for the table step, about 80 screens of scrolling
+TABLE_ROWS = 1000
+TABLE_PAGE = 12
+GENERATED = 1700000000000
+FEED_URL = "https://earthquake.usgs.gov/earthquakes/"\
+    "feed/v1.0/summary/bench_{}.geojson"
+
+_alerts = [None] * 46 + ["green", "green", "yellow", "orange", "red"]
+
+
+def makeFeature(r, n):
+    # One feature like the summary feeds', with their share of nulls
+    eventId = f"bm{n:08d}"
+    mag = None if r.random() < 0.02 else round(r.uniform(-1.0, 8.5), 2)
+    mmi = round(r.uniform(1.0, 9.0), 3) if r.random() < 0.05 else None
+    felt = r.randint(1, 5000) if r.random() < 0.1 else None
+    eventTime = GENERATED - r.randint(0, 30 * 86400000)
+    lon, lat = round(r.uniform(-180, 180), 4), round(r.uniform(-85, 85), 4)
+    return {
+        "type": "Feature",
+        "properties": {
+            "mag": mag,
+            "place": f"{r.randint(1, 200)} km {r.choice('NSEW')} of "
+                     f"Place {n % 5000}",
+            "time": eventTime,
+            "updated": eventTime + r.randint(0, 86400000),
+            "tz": None,
+            "url": "https://earthquake.usgs.gov/earthquakes/eventpage/"
+                   + eventId,
+            "detail": "https://earthquake.usgs.gov/earthquakes/feed/v1.0/"
+                      f"detail/{eventId}.geojson",
+            "felt": felt,
+            "cdi": None if felt is None else round(r.uniform(1, 8), 1),
+            "mmi": mmi,
+            "alert": None if mmi is None else r.choice(_alerts),
+            "status": r.choice(("automatic", "reviewed")),
+            "tsunami": 0,
+            "sig": r.randint(0, 1000),
+            "net": "bm",
+            "code": f"{n:08d}",
+            "ids": f",{eventId},",
+            "sources": ",bm,",
+            "types": ",origin,phase-data,",
+            "nst": None,
+            "dmin": None,
+            "rms": round(r.uniform(0, 1.5), 2),
+            "gap": None,
+            "magType": r.choice(("ml", "md", "mb", "mww")),
+            "type": "earthquake",
+            "title": f"M {mag} - Place {n % 5000}",
+        },
+        "geometry": {
+            "type": "Point",
+            "coordinates": [lon, lat, round(r.uniform(-3, 700), 2)],
+        },
+        "id": eventId,
+    }
+
+
+def writeFeed(path, count, seed=1):
+    # Synthetic feed of count events, written a feature at a time
+    r = random.Random(seed)
+    metadata = {
+        "generated": GENERATED,
+        "url": FEED_URL.format(count),
+        "title": f"Benchmark feed, {count:,} events",
+        "status": 200,
+        "api": "1.10.3",
+        "count": count,
+    }
+    with open(path, "w") as f:
+        f.write('{"type":"FeatureCollection","metadata":')
+        f.write(json.dumps(metadata))
+        f.write(',"features":[')
+        for n in range(count):
+            if n:
+                f.write(",")
+            f.write(json.dumps(makeFeature(r, n)))
+        f.write('],"bbox":[-180,-85,-3,180,85,700]}')
+
+
+def _formatTable(dataset):
+    # What the table does while scrolling: formatRow for rows on screen
+    gui = SimpleNamespace(data=dataset, newIds=set())
+    view = dataset.view("mag")
+    step = max(1, len(view) // TABLE_ROWS)
+    positions = range(0, len(view), step)[:TABLE_ROWS]
+    # a screen at a time, as the table asks for them
+    for start in range(0, len(positions), TABLE_PAGE):
+        EarthquakeGUI.formatRows(gui, [
+            view.row(n) for n in positions[start:start + TABLE_PAGE]])
+
+
+def steps(count, cache):
+    # (name, setup, run) for each step.  setup() makes what run()
+    # needs and is not timed.
+    url = FEED_URL.format(count)
+    name = f"bench_{count}"
+
+    def parsed():
+        return getDataFile(url)
+
+    def dataset():
+        return Dataset(loadHeaderInfo(parsed()), getFileFeed(url)[1])
+
+    def noSnapshot():
+        try:
+            os.remove(cache.snapshotPath(name))
+        except OSError:
+            pass
+
+    def snapshot():
+        if getFileFeed(url) is None:
+            raise RuntimeError(f"{name} is not cached")
+
+    result = [
+        ("getDataFile", None, lambda _: getDataFile(url)),
+        ("loadHeaderInfo", parsed, loadHeaderInfo),
+        ("loadList", parsed, loadList),
+        ("loadStore", parsed, loadStore),
+        ("getFileFeed json", noSnapshot, lambda _: getFileFeed(url)),
+        ("getFileFeed snapshot", snapshot, lambda _: getFileFeed(url)),
+    ]
+    for sortName in SORT_KEYS:
+        result.append((f"sortData {sortName}", dataset,
+                       lambda d, s=sortName: d.view(s)))
+    result.append(("table rows", dataset, _formatTable))
+    return result
+
+
+def measure(setup, run, repeat):
+    # best time of repeat runs, then the peak memory of one more
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        t1 = time.perf_counter()
+        run(arg)
+        seconds = time.perf_counter() - t1
+        best = seconds if best is None else min(best, seconds)
+        del arg
+    arg = setup() if setup is not None else None
+    tracemalloc.start()
+    try:
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": best, "peakBytes": peak}
+
+
+def runBenchmarks(sizes, repeat, dataDir):
+    cacheDir = tempfile.mkdtemp(prefix="bench_cache_")
+    cache = EarthquakeData._cache = FeedCache(cacheDir)
+    results = {}
+    try:
+        for count in sizes:
+            source = os.path.join(dataDir, f"bench_{count}.geojson")
+            if not os.path.exists(source):
+                logging.info(f"writing {count:,} event feed")
+                writeFeed(source, count)
+            name = f"bench_{count}"
+            partFile = cache.partPath(name)
+            shutil.copyfile(source, partFile)
+            cache.store(name, partFile, GENERATED)
+            for step, setup, run in steps(count, cache):
+                result = measure(setup, run, repeat)
+                results[f"{count}/{step}"] = result
+                logging.info(
+                    f"{count:>9,} {step:<22} {result['seconds']:9.4f}s "
+                    f"{result['peakBytes'] / 2**20:9.1f} MB")
+    finally:
+        EarthquakeData._cache = None
+        shutil.rmtree(cacheDir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Steps that got worse than the baseline, as messages
+    failures = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        limit = 1 + tolerance
+        if (result["seconds"] > MIN_SECONDS
+                and result["seconds"] > old["seconds"] * limit):
+            failures.append(
+                f"{key}: {result['seconds']:.4f}s, baseline "
+                f"{old['seconds']:.4f}s")
+        if (result["peakBytes"] > MIN_BYTES
+                and result["peakBytes"] > old["peakBytes"] * limit):
+            failures.append(
+                f"{key}: {result['peakBytes']:,} bytes, baseline "
+                f"{old['peakBytes']:,} bytes")
+    return failures
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time loading, sorting and showing large feeds.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=SIZES,
+        help="events per feed (default 1000 10000 100000 1000000)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs of each step, the best is kept")
+    parser.add_argument("--baseline", default=BaselineFile)
+    parser.add_argument("--save", action="store_true",
+                        help="save the results as the new baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=TOLERANCE,
+        help="fraction a step may get worse by (default 0.5)")
+    parser.add_argument(
+        "--data-dir",
+        help="keep the synthetic feeds here to reuse them next time")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    dataDir = args.data_dir or tempfile.mkdtemp(prefix="bench_data_")
+    os.makedirs(dataDir, exist_ok=True)
+    try:
+        results = runBenchmarks(args.sizes, args.repeat, dataDir)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(dataDir, ignore_errors=True)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            }, f, indent=1)
+        logging.info(f"saved baseline {args.baseline}")
+        return 0
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        logging.info(f"no baseline {args.baseline}, use --save to make one")
+        return 0
+    if baseline.get("python") != platform.python_version():
+        logging.warning(
+            f"baseline is from Python {baseline.get('python')}")
+    failures = compare(results, baseline["results"], args.tolerance)
+    for failure in failures:
+        logging.error(f"worse than baseline - {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+"""
+Description: Command line version, for machines with no display
+
+Fetches any number of feeds at the same time, parses them in separate
+processes and writes the events as CSV or JSON Lines, either to stdout
+or to one file per feed.
+
+    python cliEarthquakes.py 4.5_week 2.5_day
+    python cliEarthquakes.py --format jsonl --output-dir out every
+    python cliEarthquakes.py --archive earthquake_archive.sqlite every
+    python cliEarthquakes.py --watch 2.5_hour 4.5_day
+    python cliEarthquakes.py --backfill 2024-01-01 --min-magnitude 4.5
+
+With --watch the feeds are polled as often as USGS updates them and
+only new or updated events are written to stdout (files in the output
+directory are rewritten).  New and updated events are also checked
+against the watches in earthquake_watches.json (or --watches) and the
+matches logged.  --backfill gets older events from the FDSN
+event service, merged with any feeds given, as the feed "backfill".
+
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import logging
+
+from EarthquakeArchive import EventArchive
+from EarthquakeBackfill import (FDSN_BASE, BackfillError, backfill,
+                                mergeStores, parseTime)
+from EarthquakeCache import FEED_BASE, FEED_NAMES, feedName, feedUrl
+from EarthquakeData import getCache, getWebFeed, readFeed
+from EarthquakeMetrics import METRICS_ENV, metrics
+from EarthquakeScheduler import RefreshScheduler
+from EarthquakeStore import diffStores
+from EarthquakeWatch import WatchList, loadWatches
+
+# Fields written for every event, in this order
+FIELDS = ("feed", "id", "time", "updated", "mag", "mmi", "alert", "felt",
+          "place", "lon", "lat", "depth", "url")
+FORMATS = ("csv", "jsonl")
+
+
+def isoTime(ms):
+    # ms since the epoch to an ISO 8601 UTC time
+    if not ms:
+        return None
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat(
+        timespec="milliseconds").replace("+00:00", "Z")
+
+
+def eventRecords(feed, events):
+    # The events of a store as dicts with the FIELDS keys
+    for event in events:
+        yield {
+            "feed": feed,
+            "id": event.id,
+            "time": isoTime(event.time),
+            "updated": isoTime(event.updated),
+            "mag": event.mag,
+            "mmi": event.mmi,
+            "alert": event.alert,
+            "felt": event.felt,
+            "place": event.place,
+            "lon": event.lon,
+            "lat": event.lat,
+            "depth": event.depth,
+            "url": event.url,
+        }
+
+
+def writeRecords(records, out, fmt, csvHeader=True):
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=FIELDS)
+        if csvHeader:
+            writer.writeheader()
+        writer.writerows(records)
+    else:
+        for record in records:
+            out.write(json.dumps(record))
+            out.write("\n")
+
+
+def convertFeed(feed, path, fmt, outputDir=None, archivePath=None):
+    # Parse one cached feed file.  Runs in a worker process, so it only
+    # reads the file and does not use the cache index.  The events are
+    # also added to the archive at archivePath if one is given.
+    # output: (the formatted text when outputDir is None or else the
+    #         event count, the metrics collected here)
+    with open(path, "rb") as f:
+        header, events = readFeed(f)
+    if archivePath is not None:
+        with metrics.timer("archive"):
+            EventArchive(archivePath).ingest(events)
+    records = eventRecords(feed, events)
+    if outputDir is None:
+        out = io.StringIO()
+        with metrics.timer("write"):
+            writeRecords(records, out, fmt, csvHeader=False)
+        return out.getvalue(), metrics.take()
+    outFile = os.path.join(outputDir, f"{feed}.{fmt}")
+    with open(outFile, "w", newline="") as out, metrics.timer("write"):
+        writeRecords(records, out, fmt)
+    return len(events), metrics.take()
+
+
+def expandFeeds(feeds, base=FEED_BASE):
+    # Feed names or urls to urls.  "every" means every summary feed.
+    urls = []
+    for feed in feeds:
+        names = FEED_NAMES if feed == "every" else (feed,)
+        for name in names:
+            urls.append(name if "://" in name else feedUrl(name, base))
+    return urls
+
+
+def fetchAll(urls, jobs, parse=False, current=None):
+    # Download (or revalidate) every feed into the cache at once.
+    # current maps urls to the (header, events) already held for them.
+    # output: list of FetchResult or None, in the order of urls
+    current = current or {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(
+            lambda urlData: getWebFeed(urlData, current.get(urlData),
+                                       parse=parse), urls))
+
+
+def watch(urls, args):
+    # Poll the feeds until interrupted, writing the events that are new
+    # or updated each time a feed changes
+    scheduler = RefreshScheduler()
+    for urlData in urls:
+        scheduler.add(urlData, now=True)
+    held = {}
+    csvHeader = True
+    archive = EventArchive(args.archive) if args.archive else None
+    watchlist = WatchList(loadWatches(args.watches))
+    try:
+        while True:
+            due = scheduler.due()
+            results = fetchAll(due, args.jobs, parse=True, current=held)
+            for urlData, result in zip(due, results):
+                if result is None:
+                    logging.error(f"Could not get {urlData}")
+                    scheduler.done(urlData, False)
+                    continue
+                old = held.get(urlData)
+                held[urlData] = (result.header, result.events)
+                # USGS regenerates the feeds every minute whether or not
+                # any event changed, so a new download is compared with
+                # the last by content
+                ids = None
+                if old is not None:
+                    diff = diffStores(old[1], result.events)
+                    ids = diff.added + diff.updated
+                    changed = any(diff)
+                else:
+                    changed = True
+                # status is None when the feed came from the fresh
+                # cache, without asking USGS
+                scheduler.done(urlData, changed,
+                               asked=result.status is not None)
+                if not changed:
+                    continue
+                watchlist.check(result.events, ids)
+                if archive is not None:
+                    archive.ingest(result.events)
+                feed = feedName(urlData)
+                if args.output_dir:
+                    outFile = os.path.join(args.output_dir,
+                                           f"{feed}.{args.format}")
+                    with open(outFile, "w", newline="") as out:
+                        writeRecords(eventRecords(feed, result.events), out,
+                                     args.format)
+                    logging.info(f"{feed}: {len(result.events):,} events")
+                    continue
+                events = result.events
+                if ids is not None:
+                    events = events.subset([events.row(i) for i in ids])
+                writeRecords(eventRecords(feed, events), sys.stdout,
+                             args.format, csvHeader)
+                csvHeader = False
+                sys.stdout.flush()
+            if due and args.metrics:
+                metrics.dump(args.metrics)
+            delay = scheduler.nextDelay()
+            if delay is None:
+                return 0
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        return 0
+
+
+def backfillFeeds(urls, args):
+    # Events from the FDSN service between --backfill and --until,
+    # merged with those of the feeds
+    try:
+        start = parseTime(args.backfill)
+        end = parseTime(args.until) if args.until else int(
+            time.time() * 1000)
+    except ValueError as e:
+        logging.error(f"Bad time - {e}")
+        return 1
+    results = fetchAll(urls, args.jobs, parse=True)
+    failed = [u for u, r in zip(urls, results) if r is None]
+    for urlData in failed:
+        logging.error(f"Could not get {urlData}")
+    try:
+        events = backfill(start, end, args.min_magnitude, args.fdsn_url,
+                          args.jobs, args.parse_jobs)
+    except BackfillError as e:
+        logging.error(f"Backfill failed - {e}")
+        return 1
+    events = mergeStores([events] + [r.events for r in results if r])
+    logging.info(f"backfill: {len(events):,} events")
+    if args.archive:
+        with metrics.timer("archive"):
+            EventArchive(args.archive).ingest(events)
+    records = eventRecords("backfill", events)
+    if args.output_dir:
+        outFile = os.path.join(args.output_dir, f"backfill.{args.format}")
+        with open(outFile, "w", newline="") as out:
+            writeRecords(records, out, args.format)
+    else:
+        writeRecords(records, sys.stdout, args.format)
+    if args.metrics:
+        metrics.dump(args.metrics)
+    return 1 if failed else 0
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fetch USGS earthquake feeds and write the events.")
+    parser.add_argument(
+        "feeds", nargs="*",
+        help="feed names such as 4.5_week, urls, or 'every' for all "
+             "the summary feeds")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="csv")
+    parser.add_argument(
+        "-o", "--output-dir",
+        help="write one file per feed here instead of to stdout")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=8,
+        help="feeds to download at the same time (default 8)")
+    parser.add_argument(
+        "-p", "--parse-jobs", type=int, default=os.cpu_count() or 1,
+        help="processes to parse with, 1 to parse in this process")
+    parser.add_argument("--base-url", default=FEED_BASE,
+                        help="where to find feeds given by name")
+    parser.add_argument(
+        "--archive", metavar="PATH",
+        help="also add the events to this SQLite archive")
+    parser.add_argument(
+        "--metrics", metavar="PATH", default=os.environ.get(METRICS_ENV),
+        help="write stage timings and counters here, as Prometheus "
+             "text if PATH ends in .prom and JSON otherwise")
+    parser.add_argument(
+        "-w", "--watch", action="store_true",
+        help="keep polling the feeds and write what changes")
+    parser.add_argument(
+        "--watches", metavar="PATH",
+        help="watches to check with --watch (default "
+             "earthquake_watches.json)")
+    parser.add_argument(
+        "--backfill", metavar="START",
+        help="also get the events since START (e.g. 2024-01-31) from "
+             "the FDSN event service")
+    parser.add_argument("--until", metavar="END",
+                        help="end of the backfill (default now)")
+    parser.add_argument("--min-magnitude", type=float,
+                        help="smallest magnitude to backfill")
+    parser.add_argument("--fdsn-url", default=FDSN_BASE,
+                        help="where to find the FDSN event service")
+    args = parser.parse_args(argv)
+    if not args.feeds and not args.backfill:
+        parser.error("give at least one feed, or --backfill")
+    if args.backfill and args.watch:
+        parser.error("--backfill and --watch cannot be used together")
+    return args
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    urls = expandFeeds(args.feeds, args.base_url)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    if args.watch:
+        return watch(list(dict.fromkeys(urls)), args)
+    if args.backfill:
+        return backfillFeeds(urls, args)
+    results = fetchAll(urls, args.jobs)
+    failed = [u for u, r in zip(urls, results) if r is None]
+    for urlData in failed:
+        logging.error(f"Could not get {urlData}")
+    cache = getCache()
+    work = [(feedName(u), cache.path(feedName(u)))
+            for u, r in zip(urls, results) if r is not None]
+    if args.parse_jobs > 1 and len(work) > 1:
+        # forked workers start with a copy of these metrics, clear them
+        # so they are not counted twice
+        pool = ProcessPoolExecutor(max_workers=args.parse_jobs,
+                                   initializer=metrics.reset)
+    else:
+        pool = ThreadPoolExecutor(max_workers=1)
+    with pool:
+        futures = [pool.submit(convertFeed, feed, path, args.format,
+                               args.output_dir, args.archive)
+                   for feed, path in work]
+        if args.output_dir is None and args.format == "csv":
+            csv.DictWriter(sys.stdout, fieldnames=FIELDS).writeheader()
+        # results are written in the order the feeds were given
+        for (feed, _), future in zip(work, futures):
+            result, collected = future.result()
+            metrics.merge(collected)
+            if args.output_dir is None:
+                sys.stdout.write(result)
+            else:
+                logging.info(f"{feed}: {result:,} events")
+    if args.metrics:
+        metrics.dump(args.metrics)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,35 @@
 """
 Description: My first attempt at a GUI for the earthquake data
 
+The window is shown straight away and the feed loaded in the
+background, so modules only needed for loading (urllib, ssl, sqlite3)
+or for a click (webbrowser) are imported when they are first used.
 """
 
 # Imports
-import webbrowser
-from datetime import datetime, timedelta, timezone
-from tkinter import Menu, StringVar, BooleanVar, Tk, messagebox, ttk
+import time
 
-import pytz
-from tzlocal import get_localzone
-from EarthquakeData import getDataFile, getWebData, loadHeaderInfo, loadList
+# startup is timed from here, before the slower imports
+STARTED = time.perf_counter()
+
+import queue
+from datetime import datetime, timezone
+from tkinter import (Menu, StringVar, BooleanVar, Tk, Toplevel, messagebox,
+                     ttk)
+
+from EarthquakeArchive import ARCHIVE_URL, EventArchive
+from EarthquakeCache import feedName
+from EarthquakeLoader import (ARCHIVE, DONE, FILE, PROGRESS, WEB,
+                              FeedLoader)
+from EarthquakeFilter import EventFilter, FilterIndex
+from EarthquakeMap import MapView
+from EarthquakeMetrics import (dumpFromEnvironment, metrics,
+                               serveFromEnvironment)
+from EarthquakeScheduler import RefreshScheduler
+from EarthquakeStore import ALERTS, SORT_KEYS, Dataset, FilteredView
+from EarthquakeTable import SELECTED, EventTable
+from EarthquakeTime import ago, agoAll, formatter
+from EarthquakeWatch import WatchList, describe, loadWatches
 
 import logging
 
@@ -23,6 +42,18 @@ logging.basicConfig(
 urlData = "https://earthquake.usgs.gov/earthquakes/"\
     "feed/v1.0/summary/2.5_day.geojson"
 
+# How often the GUI checks for results from the loader thread (ms)
+POLL_MS = 50
+# Wait after a filter field changes before filtering, so typing a
+# number does not filter once per key (ms)
+FILTER_DELAY_MS = 250
+# How often the "minutes ago" fields and table column are redone (ms)
+AGE_REFRESH_MS = 30000
+# Most events shown when browsing the archive, newest first
+ARCHIVE_LIMIT = 200000
+# Most watch matches listed in one message box
+WATCH_SHOWN = 10
+
 # TODO - Add environment variable for persistent options
 # ADD  - Add colours to alert (Black on Red, Orange, Yellow, Green)
 
@@ -35,34 +66,258 @@ class EarthquakeGUI:
         exit()
 
     def _refreshData(self):
-        logging.debug("")
-        t1 = datetime.now()
-        JSONdata = getWebData(urlData)
-        t2 = datetime.now()
-        tdweb = t2 - t1
-        if JSONdata:
-            hList = loadHeaderInfo(JSONdata)
+        if self.data is not None and self.data.header["url"] == ARCHIVE_URL:
+            self._browseArchive()
+        else:
+            self._refreshFeed()
+
+    def _refreshFeed(self):
+        # Refresh the live feed, even if the archive is on screen
+        current = None
+        if self.data is not None and self.data.header["url"] == urlData:
+            current = (self.data.header, self.data.events)
+        self._startLoad(WEB, urlData, current)
+
+    def _browseArchive(self):
+        # Show archived events.  The time, magnitude and location
+        # filter fields narrow the query; the rest filter the table.
+        criteria = self.filterCriteria()
+        self._startLoad(ARCHIVE, ARCHIVE_URL, dict(
+            since=criteria.since, minMag=criteria.minMag,
+            maxMag=criteria.maxMag, near=criteria.near,
+            limit=ARCHIVE_LIMIT))
+
+    def _archiveChanged(self, *args):
+        self.loader.ingest = self.archiving.get()
+
+    def _startLoad(self, source, url, current=None, auto=False):
+        # The feed is fetched and parsed on the loader thread.  Asking
+        # for another one before it finishes cancels this one.  auto is
+        # True for a refresh the scheduler asked for.
+        if self._loading is not None and self._loading[0] == WEB:
+            self.scheduler.cancelled(self._loading[1])
+        self._loading = (source, url, auto)
+        self.loader.request(source, url, current)
+        if url is None:
+            name = "the last feed"
+        elif url == ARCHIVE_URL:
+            name = "archive"
+        else:
+            name = feedName(url)
+        self.status.set(f"Loading {name} ...")
+        self.progress.configure(mode="indeterminate")
+        self.progress.start()
+
+    def _pollLoader(self):
+        # Pick up messages from the loader thread, ignoring any left
+        # over from a request that has been replaced
+        try:
+            while True:
+                message = self.loader.results.get_nowait()
+                if not self.loader.isCurrent(message[1]):
+                    continue
+                if message[0] == PROGRESS:
+                    self._showProgress(*message[2:])
+                elif message[0] == DONE:
+                    self._loadDone(*message[2:])
+        except queue.Empty:
+            pass
+        finally:
+            # a message that fails must not stop the polling
+            self.win.after(POLL_MS, self._pollLoader)
+
+    def _showProgress(self, bytesRead, totalBytes):
+        if totalBytes:
+            if str(self.progress["mode"]) != "determinate":
+                self.progress.stop()
+                self.progress.configure(mode="determinate", maximum=100)
+            self.progress["value"] = 100 * bytesRead / totalBytes
+        self.status.set(f"Loading ... {bytesRead / 1024:,.0f} KB")
+
+    def _loadDone(self, source, feed, seconds):
+        url, auto = self._loading[1:] if self._loading else (None, False)
+        self._loading = None
+        changed = False
+        self.progress.stop()
+        self.progress.configure(mode="determinate", value=0)
+        self.status.set("")
+        metrics.observe(f"load_{source}", seconds)
+        if source == ARCHIVE:
+            if feed:
+                logging.info(f"Archive query - {feed[0]['count']:,} "
+                             f"records in {seconds: .3}s")
+                self.showFeed(*feed)
+            else:
+                messagebox.showerror(
+                    "Archive error",
+                    "Error querying the archive. Check console for error.")
+                logging.error("Error querying archive")
+        elif source == FILE:
+            # show what is in the cache and then bring it up to date,
+            # or go to the web if it is not in the cache
+            if feed:
+                self.showFeed(*feed)
+            self._refreshData()
+        elif (feed and feed.fromCache and self.data is not None
+                and feed.events is self.data.events):
+            # USGS has not regenerated the feed, nothing to redo
             logging.info(
-                f"Web Retrieval - {hList['count']:,} "
-                f"records in {tdweb.total_seconds(): .3}s")
-            eList = loadList(JSONdata)
-            eList = self.sortData(eList)
-            self.updateHeaderFields(hList)
-            self.updateFields(eList, self.summarySelected.current())
+                f"Web Retrieval - not modified in {seconds: .3}s")
+            self.updateHeaderFields(self.data.header)
+        elif feed:
+            logging.info(
+                f"Web Retrieval - {feed.header['count']:,} "
+                f"records, {feed.bytesTransferred:,} bytes in "
+                f"{seconds: .3}s")
+            changed = self.showFeed(feed.header, feed.events)
+        elif auto:
+            # no message box every minute while USGS cannot be reached
+            logging.error("Error retrieving file for automatic refresh")
         else:
             messagebox.showerror(
                 "USGS File error",
                 "Error retrieving "
                 "data from USGS web site. Check console for error.")
             logging.error("Error retrieving file")
+        if source == WEB:
+            # a feed served from the fresh cache or made from a wider
+            # one was not asked of USGS (status None)
+            self.scheduler.done(url, changed,
+                                asked=not feed or feed.status is not None)
+            self._scheduleRefresh()
+        dumpFromEnvironment()
 
-    def _comboCallbackFunc(self, event, data):
-        logging.debug("")
-        # When combo box changes, updated data with new selection
-        self.updateFields(data, self.summarySelected.current())
+    def _autoRefreshChanged(self, *args):
+        self._scheduleRefresh()
+
+    def _scheduleRefresh(self):
+        # Set the timer for the next automatic refresh
+        if self._refreshJob is not None:
+            self.win.after_cancel(self._refreshJob)
+            self._refreshJob = None
+        delay = self.scheduler.nextDelay()
+        if self.autoRefresh.get() and delay is not None:
+            self._refreshJob = self.win.after(int(delay * 1000) + 1,
+                                              self._autoRefresh)
+
+    def _autoRefresh(self):
+        # Refresh the live feed if it is due.  It waits for any load in
+        # progress, and while the archive is on screen.
+        self._refreshJob = None
+        for url in self.scheduler.due():
+            if (url == urlData and self._loading is None
+                    and self.data is not None
+                    and self.data.header["url"] == urlData):
+                current = (self.data.header, self.data.events)
+                self._startLoad(WEB, url, current, auto=True)
+            else:
+                self.scheduler.cancelled(url)
+        self._scheduleRefresh()
+
+    def _watchFeed(self, url):
+        # Make url the feed refreshed automatically
+        if self.scheduler.urls() != [url]:
+            self.scheduler.clear()
+            self.scheduler.add(url)
+            self._scheduleRefresh()
+
+    def showFeed(self, header, events):
+        # Display a newly loaded feed.  A new version of the feed that
+        # is on screen is applied as a diff, so only the events that
+        # changed are re-sorted and re-formatted.
+        # output: True if any events changed
+        changed = True
+        if (self.data is not None
+                and header["url"] == self.data.header["url"]):
+            selected = self.selectedId()
+            with metrics.timer("diff"):
+                diff = self.data.update(header, events)
+            self.applyDiff(diff, selected)
+            changed = any(diff)
+            ids = diff.added + diff.updated
+        else:
+            first = self.data is None
+            self.data = Dataset(header, events)
+            self.newIds = set()
+            self.sortData()
+            self.updateTableData()
+            if first:
+                self._startupTime("startup_data", "First feed shown")
+            ids = None
+        if header["url"] != ARCHIVE_URL:
+            self._checkWatches(events, ids)
+        if self.mapView is not None:
+            self.mapView.setData(self.data)
+        self.updateHeaderFields(header)
+        self.updateFields(self.data.events, self.selectedRow())
+        return changed
+
+    def _checkWatches(self, events, ids):
+        # Check the new and updated events (all of them if ids is None)
+        # against the watches.  Matches are logged and listed in a
+        # message box once the feed is on screen.
+        matches = self.watchlist.check(events, ids)
+        if not matches:
+            return
+        lines = [describe(match) for match in matches[:WATCH_SHOWN]]
+        if len(matches) > WATCH_SHOWN:
+            lines.append(f"and {len(matches) - WATCH_SHOWN:,} more, "
+                         "see the console")
+        self.win.bell()
+        self.win.after_idle(lambda: messagebox.showwarning(
+            "Earthquake watch", "\n".join(lines)))
+
+    def _showMap(self):
+        # The map opens in its own window, made the first time
+        if self.mapView is not None:
+            self.mapView.winfo_toplevel().lift()
+            return
+        window = Toplevel(self.win)
+        window.title("Earthquake Map")
+        window.columnconfigure(0, weight=1)
+        window.rowconfigure(0, weight=1)
+        self.mapView = MapView(window, onPick=self._mapPicked)
+        self.mapView.grid(column=0, row=0, sticky="NSEW")
+        window.protocol("WM_DELETE_WINDOW", self._closeMap)
+        if self.data is not None:
+            self.mapView.setData(self.data)
+
+    def _closeMap(self):
+        self.mapView.winfo_toplevel().destroy()
+        self.mapView = None
+
+    def _mapPicked(self, box, eventId):
+        # Show just the events of a bin clicked on the map, with its
+        # largest event selected.  The filter fields are cleared, and
+        # changing any of them goes back to filtering on them.
+        self._clearFilter()
+        if self._filterJob is not None:
+            self.win.after_cancel(self._filterJob)
+            self._filterJob = None
+        self.mapBox = box
+        south, west, north, east = box
+        self.status.set(f"Table shows the map bin {south:.2f} to "
+                        f"{north:.2f} lat, {west:.2f} to {east:.2f} lon")
+        self.updateTableData(eventId)
+
+    def _startupTime(self, stage, what):
+        seconds = time.perf_counter() - STARTED
+        metrics.observe(stage, seconds)
+        logging.info(f"{what} {seconds:.3f}s after starting")
+
+    def _tableCallbackFunc(self, event):
+        # When the table selection changes, updated data with new
+        # selection
+        self.updateFields(self.data.events, self.selectedRow())
+
+    def _sortCallbackFunc(self, name):
+        # Table heading clicked, only some columns are sort orders
+        if name in SORT_KEYS:
+            self.sortOption.set(name)
 
     def _webCallbackFunc(self, data):
         logging.debug("")
+        import webbrowser
         webbrowser.open_new(data)
 
     def getNewData(self, timeString):
@@ -73,52 +328,163 @@ class EarthquakeGUI:
         logging.debug(urlData[x + 8:y])
         urlData = str(urlData.replace(urlData[x + 8:y], timeString, 1))
         logging.debug(urlData)
-        self._refreshData()
-        # When combo box changes, updated data with new selection
-        # self.updateFields(data, self.summarySelected.current())
+        self._refreshFeed()
         # return urlData
 
-    def updateComboBoxData(self, data):
-        logging.debug("")
-        dropdownlist = []
-        self.summarySelected.delete(0)
-        if len(data) > 0:
-            for n, _ in enumerate(data):
-                mag = f"{data[n][1]:.1f}"
-                mmi = f"{data[n][8]:.3f}"
-                dropdownlist.append(
-                    mag + "  -  " + mmi + "  -  " + str(data[n][2]))
-            self.summarySelected["values"] = dropdownlist
-            self.summarySelected.current(0)
-            self.summarySelected.bind("<<ComboboxSelected>>", lambda event,
-                                      arg=data: self._comboCallbackFunc(
-                                          event, arg),)
+    def applyDiff(self, diff, selected):
+        # The views were updated with the data, only the table needs
+        # redrawing
+        logging.info(
+            f"{len(diff.added):,} new, {len(diff.updated):,} updated, "
+            f"{len(diff.removed):,} removed")
+        metrics.count("events_added", len(diff.added))
+        metrics.count("events_updated", len(diff.updated))
+        metrics.count("events_removed", len(diff.removed))
+        self.newIds = set(diff.added)
+        self.updateTableData(selected)
+
+    def selectedRow(self):
+        # Row in the event store for the table selection, or None
+        return self.table.selectedRow()
+
+    def selectedId(self):
+        return self.table.selectedId()
+
+    def formatRows(self, rows):
+        # Values and tags for table rows.  Only called for the rows on
+        # screen, with the times of all of them formatted together.
+        events = self.data.events
+        times = [events.time[row] for row in rows]
+        localTimes = formatter(local=True).formatAll(times)
+        ages = agoAll(times)
+        formatted = []
+        for row, localTime, age in zip(rows, localTimes, ages):
+            felt = events.felt[row]
+            values = (
+                f"{events.mag[row]:.1f}",
+                f"{events.mmi[row]:.3f}",
+                ALERTS[events.alert[row]],
+                "" if felt < 0 else felt,
+                f"{events.depth[row]:.1f}",
+                localTime,
+                age,
+                events.place[row],
+            )
+            formatted.append(
+                (values, ("new",) if events.ids[row] in self.newIds else ()))
+        return formatted
+
+    def _refreshAges(self):
+        # Only the ages change with time, and only the rows on screen
+        # and the selected event show them
+        if self.data is not None:
+            self.table.refresh()
+            self.fileDelta.set(ago(self.data.header["timeStamp"]))
+            row = self.selectedRow()
+            if row is not None:
+                self.deltaEntry.set(ago(self.data.events.time[row]))
+        self.win.after(AGE_REFRESH_MS, self._refreshAges)
+
+    def updateTableData(self, selected=None):
+        view = self.view
+        with metrics.timer("filter"):
+            rows = self.filterRows()
+            if rows is not None:
+                view = FilteredView(self.view, rows)
+        shown = f"Showing {len(view):,} of {len(self.view):,}"
+        if self.mapBox is not None:
+            shown += " in the map bin"
+        mag = self.data.events.stats("mag", rows)
+        if mag["count"]:
+            shown += (f", magnitude {mag['min']:.1f} to {mag['max']:.1f}"
+                      f" (mean {mag['mean']:.1f})")
+        self.filterCount.set(shown)
+        with metrics.timer("widget"):
+            self.table.setData(view, self.formatRows, selected)
+
+    def filterRows(self):
+        # Rows that pass the filter fields, or the map bin picked, or
+        # None if no filter is set.
+        # The indexes are built once per version of the data.
+        if self.mapBox is not None:
+            criteria = EventFilter(box=self.mapBox)
         else:
-            self.summarySelected["values"] = dropdownlist
-            self.summarySelected.set("")
+            criteria = self.filterCriteria()
+        return self.data.cached("filter", FilterIndex).select(criteria)
 
-    def sortData(self, data):
-        logging.debug(f"{self.sortOption.get()}")
-        try:
-            if self.sortOption.get() == '2':
-                s_eList = sorted(data, key=lambda x: (
-                    x[8], x[1], x[7]), reverse=True)
-            else:
-                s_eList = sorted(data, key=lambda x: (
-                    x[1], x[7]), reverse=True)
-            eList = s_eList[:]
-        except:
-            logging.error("Error sorting list - most likely bad data")
-        self.updateComboBoxData(eList)
-        return eList
-
-    def __init__(self, data, header):
+    def filterCriteria(self):
+        # EventFilter from the filter fields.  Fields that are blank or
+        # not a number are ignored.
+        def number(name):
+            try:
+                return float(self.filterVars[name].get())
+            except ValueError:
+                return None
+        since = None
+        hours = number("hours")
+        if hours is not None:
+            now = datetime.now(timezone.utc).timestamp()
+            since = int((now - hours * 3600) * 1000)
+        near = None
+        lat, lon, km = number("lat"), number("lon"), number("km")
+        if None not in (lat, lon, km):
+            near = (lat, lon, km)
+        return EventFilter(
+            since=since,
+            minMag=number("minMag"), maxMag=number("maxMag"),
+            minMmi=number("minMmi"),
+            minDepth=number("minDepth"), maxDepth=number("maxDepth"),
+            minAlert=self.filterVars["alert"].get() or None,
+            near=near)
+
+    def _filterChanged(self, *args):
+        if self.mapBox is not None:
+            self.mapBox = None
+            self.status.set("")
+        if self._filterJob is not None:
+            self.win.after_cancel(self._filterJob)
+        self._filterJob = self.win.after(FILTER_DELAY_MS, self._filterNow)
+
+    def _filterNow(self):
+        self._filterJob = None
+        if self.data is not None:
+            self.updateTableData(self.selectedId())
+
+    def _clearFilter(self):
+        for var in self.filterVars.values():
+            var.set("")
+
+    def sortData(self):
+        # Each sort order is worked out once per feed and then kept up
+        # to date, so this is only a lookup after the first time
+        with metrics.timer("sort"):
+            self.view = self.data.view(self.sortOption.get())
+        return self.view
+
+    def __init__(self, data=None, header=None):
+        # Without data the window opens empty and the feed used last is
+        # loaded in the background
+        self.data = None
+        self.view = None
+        self.newIds = set()
+        self.loader = FeedLoader(EventArchive())
+        self._loading = None
+        self.scheduler = RefreshScheduler()
+        self._refreshJob = None
+        self.watchlist = WatchList(loadWatches())
+        self.mapView = None
         self.win = Tk()
         self.win.title("USGS Current Earthquake Data")
+        self.archiving = BooleanVar()
+        self.archiving.set(True)
+        self.archiving.trace("w", self._archiveChanged)
+        self.autoRefresh = BooleanVar()
+        self.autoRefresh.set(True)
+        self.autoRefresh.trace("w", self._autoRefreshChanged)
         self.checked = BooleanVar()
         self.checked.trace("w", self.mark_checked)
         self.sortOption = StringVar()
-        self.sortOption.set("1")
+        self.sortOption.set("mag")
         self.sortOption.trace("w", self.mark_sortOption)
 
         # ----- Menu Bar - Create the Menu Bar -------------------------
@@ -139,15 +505,30 @@ class EarthquakeGUI:
         sortSubMenu = Menu(optionsMenu, tearoff=False)
         optionsMenu.add_cascade(menu=sortSubMenu, label="Sort")
         sortSubMenu.add_radiobutton(
-            label="Sort by Magnitude", value="1", variable=self.sortOption)
+            label="Sort by Magnitude", value="mag", variable=self.sortOption)
         sortSubMenu.add_radiobutton(
-            label="Sort by Predictive damage or Shake(MMI)", value="2", variable=self.sortOption)
+            label="Sort by Predictive damage or Shake(MMI)", value="mmi",
+            variable=self.sortOption)
+        sortSubMenu.add_radiobutton(
+            label="Sort by Time", value="time", variable=self.sortOption)
+        sortSubMenu.add_radiobutton(
+            label="Sort by Depth", value="depth", variable=self.sortOption)
+        sortSubMenu.add_radiobutton(
+            label="Sort by Reported felt", value="felt",
+            variable=self.sortOption)
+        optionsMenu.add_checkbutton(
+            label="Save events to archive", variable=self.archiving)
+        optionsMenu.add_checkbutton(
+            label="Refresh automatically", variable=self.autoRefresh)
         # ----- Menu Bar - Create the Data Menu-------------------------
         dataMenu.add_command(label="Refresh current Data source",
                              command=self._refreshData)
         dataMenu.add_separator()
         dataSubMenu = Menu(dataMenu, tearoff=False)
         dataMenu.add_cascade(menu=dataSubMenu, label="New Data Source")
+        dataMenu.add_command(label="Browse Archive",
+                             command=self._browseArchive)
+        dataMenu.add_command(label="Show Map", command=self._showMap)
         # ----- Menu Bar - Create the Data submenu ---------------------
         d1 = [
             ["Significant", "significant"],
@@ -178,12 +559,16 @@ class EarthquakeGUI:
         self.headings_frame.grid(row=0)
         self.selection_frame = ttk.LabelFrame(
             self.headings_frame, text="selection frame")
-        self.selection_frame.configure(text=header["title"])
+        self.selection_frame.configure(
+            text="Loading ..." if header is None else header["title"])
         self.selection_frame.grid(column=0, columnspan=2, row=0,
                                   sticky="NW")
         self.file_frame = ttk.LabelFrame(self.headings_frame,
                                          text="File Info")
         self.file_frame.grid(column=2, row=0, rowspan=3, sticky="NW")
+        self.filter_frame = ttk.LabelFrame(self.headings_frame,
+                                           text="Filter")
+        self.filter_frame.grid(column=2, row=3, sticky="NW")
         self.details_frame = ttk.LabelFrame(self.mainFrame)
         self.details_frame.grid(row=1)
         self.summary_frame = ttk.LabelFrame(self.details_frame,
@@ -197,12 +582,11 @@ class EarthquakeGUI:
         self.time_frame.grid(row=1, column=1, sticky="NW")
         ttk.Label(self.selection_frame).grid(column=0, row=0,
                                              sticky="W")
-        # ----- Set up combo box and data to populate it ---------------
-        self.summarySelected = ttk.Combobox(
-            self.selection_frame, width=85, state="readonly"
-        )
-        self.summarySelected.grid(column=0, row=1)
-        self.updateComboBoxData(data)
+        # ----- Set up the event table ---------------------------------
+        self.table = EventTable(self.selection_frame,
+                                onSort=self._sortCallbackFunc)
+        self.table.grid(column=0, row=1, sticky="NSEW")
+        self.table.bind(SELECTED, self._tableCallbackFunc)
         # ----- Add File widget - File delta ---------------------------
         self.fileDelta = StringVar()
         fileDeltaEntry = ttk.Label(
@@ -228,6 +612,42 @@ class EarthquakeGUI:
             state="readonly"
         )
         fileCountEntry.grid(column=1, row=2, sticky="W")
+        # ----- Add Filter widgets ------------------------------------
+        # (key, label, column, row) - the filter updates as they change
+        self._filterJob = None
+        # (south, west, north, east) of the map bin the table is showing
+        # in place of the filter fields
+        self.mapBox = None
+        self.filterVars = {}
+        for key, label, column, row in (
+                ("hours", "Last hours:", 0, 0),
+                ("alert", "Alert at least:", 2, 0),
+                ("minMag", "Magnitude from:", 0, 1),
+                ("maxMag", "to:", 2, 1),
+                ("minMmi", "MMI from:", 0, 2),
+                ("minDepth", "Depth km from:", 0, 3),
+                ("maxDepth", "to:", 2, 3),
+                ("lat", "Near latitude:", 0, 4),
+                ("lon", "longitude:", 2, 4),
+                ("km", "within km:", 0, 5)):
+            ttk.Label(self.filter_frame, text=label).grid(
+                column=column, row=row, sticky="E")
+            var = self.filterVars[key] = StringVar()
+            if key == "alert":
+                field = ttk.Combobox(self.filter_frame, width=8,
+                                     textvariable=var, state="readonly",
+                                     values=ALERTS)
+            else:
+                field = ttk.Entry(self.filter_frame, width=10,
+                                  textvariable=var)
+            field.grid(column=column + 1, row=row, sticky="W")
+            var.trace("w", self._filterChanged)
+        ttk.Button(self.filter_frame, text="Clear",
+                   command=self._clearFilter).grid(column=3, row=5,
+                                                   sticky="W")
+        self.filterCount = StringVar()
+        ttk.Label(self.filter_frame, textvariable=self.filterCount).grid(
+            column=0, row=6, columnspan=4, sticky="W")
         # ----- Add Summary widget - Magnitude -------------------------
         ttk.Label(self.summary_frame, text="Magnitude:").grid(
             column=0, row=0, sticky="E"
@@ -326,6 +746,16 @@ class EarthquakeGUI:
             self.time_frame, width=25, textvariable=self.tz,
             state="readonly")
         tzEntry.grid(column=1, row=2, sticky="W")
+        # ----- Add Status bar - loading progress ----------------------
+        self.status_frame = ttk.Frame(self.mainFrame)
+        self.status_frame.grid(row=2, sticky="EW")
+        self.progress = ttk.Progressbar(
+            self.status_frame, length=200, mode="determinate")
+        self.progress.grid(column=0, row=0, sticky="W")
+        self.status = StringVar()
+        statusEntry = ttk.Label(
+            self.status_frame, width=60, textvariable=self.status)
+        statusEntry.grid(column=1, row=0, sticky="W")
         # ----- Add padding around fields
         self.mainFrame.grid_configure(padx=8, pady=4)
         for child in self.mainFrame.winfo_children():
@@ -336,55 +766,54 @@ class EarthquakeGUI:
                     widget.grid_configure(padx=8, pady=4)
 
         # ----- Call funtion to update fields --------------------------
-        data = self.sortData(data)
-        self.updateHeaderFields(header)
-        self.updateFields(data, self.summarySelected.current())
+        if data is None:
+            self._startLoad(FILE, None)
+        else:
+            self.showFeed(header, data)
+        self.win.after(POLL_MS, self._pollLoader)
+        # idle callbacks run in order, so this one comes after the
+        # window has been drawn
+        self.win.after_idle(self._startupTime, "startup_window",
+                            "Window shown")
+        self.win.after(AGE_REFRESH_MS, self._refreshAges)
 
     def mark_checked(self, *args):
         logging.debug("")
         print(self.checked.get())
 
     def mark_sortOption(self, *args):
-        logging.debug("")
-        print(self.sortOption.get())
-        JSONdata = getDataFile()
-        if not JSONdata:
-            self._refreshData()
-        else:
-            hList = loadHeaderInfo(JSONdata)
-            eList = loadList(JSONdata)
-            eList = self.sortData(eList)
-            self.updateHeaderFields(hList)
-            self.updateFields(eList, self.summarySelected.current())
+        if self.data is None:
+            return
+        selected = self.selectedId()
+        self.sortData()
+        self.updateTableData(selected)
+        self.updateFields(self.data.events, self.selectedRow())
 
     def updateHeaderFields(self, header):
         # Update header fields for the file
-        logging.debug("")
         global urlData
-        urlData = header["url"]
+        # urlData stays the live feed to go back to from the archive
+        if header["url"] != ARCHIVE_URL:
+            urlData = header["url"]
+            self._watchFeed(urlData)
         self.selection_frame.configure(text=header["title"])
         self.fileCount.set(header["count"])
-        utc_time = datetime.utcfromtimestamp(
-            header["timeStamp"] / 1000).replace(tzinfo=pytz.utc)
-        self.fileTime.set(utc_time.strftime("%Y-%m-%d %H:%M:%S %Z"))
-        self.fileDelta.set(deltaTime(self, utc_time))
+        self.fileTime.set(formatter().format(header["timeStamp"]))
+        self.fileDelta.set(ago(header["timeStamp"]))
 
-    def updateFields(self, data, rec):
-        logging.debug("")
-        if len(data) > 0:
+    def updateFields(self, events, row):
+        if row is not None:
             # Update fields in the display from the data record
-            self.mag.set(f"{data[rec][1]:.1f}")
-            self.place.set(data[rec][2])
-            utc_time = datetime.utcfromtimestamp(
-                data[rec][3] / 1000).replace(tzinfo=pytz.utc)
-            self.time.set(utc_time.strftime("%Y-%m-%d %H:%M:%S %Z"))
-            current_tz = utc_time.astimezone(get_localzone())
-            self.tz.set(current_tz.strftime("%Y-%m-%d %H:%M:%S %Z"))
-            self.urlName.set(data[rec][5])
-            self.felt.set(data[rec][6])
-            self.alert.set(data[rec][7])
-            self.shake.set(f"{data[rec][8]:.3f}")
-            tmpLat = data[rec][10]
+            event = events.event(row)
+            self.mag.set(f"{event.mag:.1f}")
+            self.place.set(event.place)
+            self.time.set(formatter().format(event.time))
+            self.tz.set(formatter(local=True).format(event.time))
+            self.urlName.set(event.url)
+            self.felt.set(event.felt)
+            self.alert.set(event.alert)
+            self.shake.set(f"{event.mmi:.3f}")
+            tmpLat = event.lat
             if tmpLat == 0:
                 self.lat.set("{} \xb0".format(tmpLat))
             elif tmpLat > 0:
@@ -392,7 +821,7 @@ class EarthquakeGUI:
             else:
                 tmpLat *= -1
                 self.lat.set("{} \xb0 S".format(tmpLat))
-            tmpLong = data[rec][9]
+            tmpLong = event.lon
             if tmpLong == 0:
                 self.lon.set("{} \xb0".format(tmpLong))
             elif tmpLong > 0:
@@ -400,9 +829,8 @@ class EarthquakeGUI:
             else:
                 tmpLong *= -1
                 self.lon.set("{} \xb0 W".format(tmpLong))
-            self.depth.set("{} km".format(data[rec][11]))
-            # self.lon.set(data[rec][5])
-            self.deltaEntry.set(deltaTime(self, utc_time))
+            self.depth.set("{} km".format(event.depth))
+            self.deltaEntry.set(ago(event.time))
         else:
             self.mag.set(None)
             self.place.set(None)
@@ -423,39 +851,14 @@ class EarthquakeGUI:
         )
 
 
-def deltaTime(self, timeCheck):
-    # Tells how long a date is from now (rounded to minutes, hours
-    # or days)
-    logging.debug("")
-    utc_now = datetime.now(timezone.utc)
-    delta = utc_now - timeCheck
-    hours = delta.total_seconds() / 3600
-    minutes = delta.total_seconds() / 60
-    if hours > 48:
-        days = hours / 24
-        return str("about " + "{:.0f}".format(days) + " days ago")
-    elif hours >= 2:
-        return str("about " + "{:.0f}".format(hours) + " hours ago")
-    elif delta.total_seconds() > 90:
-        return str("about " + "{:.0f}".format(minutes) + " minutes ago")
-    else:
-        return str("about a minute ago")
-
-
 def main():
 
     # root = Tk()
+    serveFromEnvironment()
 
-    # Get data from file.  If the does not exist then go to the
-    # web to update it.
-    JSONdata = getDataFile()
-    if not JSONdata:
-        JSONdata = getWebData(urlData)
-        if not JSONdata:
-            logging.error("error getting file")
-    hList = loadHeaderInfo(JSONdata)
-    eList = loadList(JSONdata)
-    root = EarthquakeGUI(eList, hList)
+    # The window loads the feed used last from the cache.  If there is
+    # none then it goes to the web for it.
+    root = EarthquakeGUI()
     root.win.mainloop()
 
 
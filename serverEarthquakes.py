@@ -0,0 +1,522 @@
+"""
+Description: Local HTTP service sharing one copy of each feed
+
+Keeps one fetcher and one in-memory Dataset per feed, refreshed on the
+USGS cadence by a RefreshScheduler, so any number of dashboards and
+scripts can query it without each of them downloading the feeds.
+
+    python serverEarthquakes.py 2.5_day 4.5_week
+    python serverEarthquakes.py --base-url http://localhost:8000/summary/
+
+GET /feeds
+    the feeds held, with their version, title and event count
+GET /feeds/NAME?sort=mag&minMag=4.5&limit=100
+    the events of a feed, filtered and sorted.  The filters are since,
+    until (ms since the epoch), minMag, maxMag, minMmi, maxMmi,
+    minDepth, maxDepth, alert (lowest level), near=lat,lon,km and
+    box=south,west,north,east; sort is one of mag, mmi, time, depth or
+    felt; offset and limit page through the result; format is json
+    (default), jsonl or csv.  NAME is a summary feed such as 4.5_week,
+    and a feed not held yet is fetched first.
+GET /feeds/NAME/stream
+    Server-Sent Events.  An "update" event carrying the added, updated
+    and removed events is sent each time the feed changes.
+GET /metrics, /metrics.json
+    stage timings and counters
+
+Responses are cached by feed, version and query, so asking again
+before the feed changes costs a dictionary lookup, and each update is
+serialized once however many clients are listening for it.
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import queue
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import logging
+
+from EarthquakeCache import FEED_BASE, FEED_NAMES, feedUrl
+from EarthquakeData import getWebFeed
+from EarthquakeDerive import deriveFeed
+from EarthquakeFilter import EventFilter, FilterIndex
+from EarthquakeMetrics import metrics
+from EarthquakeScheduler import RefreshScheduler
+from EarthquakeStore import ALERTS, SORT_KEYS, Dataset, FilteredView
+from cliEarthquakes import FORMATS, eventRecords, writeRecords
+
+PORT = 8765
+# Most responses kept in the cache, across all feeds
+RESPONSE_CACHE_SIZE = 256
+# Responses bigger than this are gzipped for clients that accept it
+GZIP_BYTES = 1024
+# Seconds between keep-alive comments on an idle event stream
+KEEPALIVE = 15
+# Updates a slow stream client may fall behind by before it is dropped
+STREAM_BACKLOG = 100
+# Longest the refresh thread sleeps, so feeds added meanwhile are seen
+MAX_SLEEP = 5
+
+_contentTypes = {
+    "json": "application/json",
+    "jsonl": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+class QueryError(ValueError):
+    # A bad query parameter, reported to the client as 400
+    pass
+
+
+def _number(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise QueryError(f"{name} must be a number")
+
+
+def _numbers(params, name, count):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        numbers = tuple(float(v) for v in value.split(","))
+    except ValueError:
+        numbers = ()
+    if len(numbers) != count:
+        raise QueryError(f"{name} must be {count} numbers, comma separated")
+    return numbers
+
+
+def _count(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise QueryError(f"{name} must be a whole number")
+    return int(value)
+
+
+def parseQuery(params):
+    # Query parameters (one value each) to
+    # output: (EventFilter, sort name, offset, limit, format)
+    alert = params.get("alert") or None
+    if alert is not None and alert not in ALERTS:
+        raise QueryError(f"alert must be one of {', '.join(ALERTS[1:])}")
+    since, until = _number(params, "since"), _number(params, "until")
+    criteria = EventFilter(
+        since=None if since is None else int(since),
+        until=None if until is None else int(until),
+        minMag=_number(params, "minMag"), maxMag=_number(params, "maxMag"),
+        minMmi=_number(params, "minMmi"), maxMmi=_number(params, "maxMmi"),
+        minDepth=_number(params, "minDepth"),
+        maxDepth=_number(params, "maxDepth"),
+        minAlert=alert,
+        near=_numbers(params, "near", 3),
+        box=_numbers(params, "box", 4))
+    sortName = params.get("sort", "time")
+    if sortName not in SORT_KEYS:
+        raise QueryError(f"sort must be one of {', '.join(SORT_KEYS)}")
+    fmt = params.get("format", "json")
+    if fmt != "json" and fmt not in FORMATS:
+        raise QueryError(f"format must be json, {' or '.join(FORMATS)}")
+    return (criteria, sortName, _count(params, "offset") or 0,
+            _count(params, "limit"), fmt)
+
+
+class FeedService:
+    # One feed held in memory and the clients streaming its updates.
+    # The Dataset is changed in place by an update, so it is only used
+    # under the lock.
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.lock = threading.Lock()
+        self.data = None
+        self.subscribers = []
+        # False when the last refresh was answered from the fresh cache
+        # or a wider feed, without asking USGS
+        self.asked = True
+
+    def refresh(self):
+        # Fetch the feed (or revalidate the cached copy, or make it from
+        # a wider feed) and move the Dataset on to it
+        # output: True if the events changed, False if not, None if the
+        #         feed could not be got
+        with self.lock:
+            current = None
+            if self.data is not None:
+                current = (self.data.header, self.data.events)
+        result = deriveFeed(self.url, current)
+        if result is None:
+            result = getWebFeed(self.url, current)
+        self.asked = result is None or result.status is not None
+        if result is None:
+            return None
+        with self.lock:
+            if self.data is None:
+                self.data = Dataset(result.header, result.events)
+                return True
+            if result.events is self.data.events:
+                # the cached copy is still current
+                self.data.header = result.header
+                return False
+            diff = self.data.update(result.header, result.events)
+            if not any(diff):
+                return False
+            message = self._updateMessage(diff)
+        self.publish(message)
+        return True
+
+    def _updateMessage(self, diff):
+        # An update event for the streams, serialized once for all
+        events = self.data.events
+        changed = [events.event(events.row(eventId))
+                   for eventId in diff.added + diff.updated]
+        records = list(eventRecords(self.name, changed))
+        body = json.dumps({
+            "feed": self.name,
+            "version": self.data.version,
+            "header": self.data.header,
+            "added": records[:len(diff.added)],
+            "updated": records[len(diff.added):],
+            "removed": diff.removed,
+        })
+        return (f"id: {self.data.version}\nevent: update\n"
+                f"data: {body}\n\n").encode()
+
+    def subscribe(self):
+        stream = queue.Queue(STREAM_BACKLOG)
+        with self.lock:
+            self.subscribers.append(stream)
+        return stream
+
+    def unsubscribe(self, stream):
+        with self.lock:
+            if stream in self.subscribers:
+                self.subscribers.remove(stream)
+
+    def isSubscribed(self, stream):
+        with self.lock:
+            return stream in self.subscribers
+
+    def publish(self, message):
+        # Hand an update to every stream.  A client that has fallen
+        # too far behind is dropped rather than held in memory.
+        with self.lock:
+            streams = list(self.subscribers)
+        for stream in streams:
+            try:
+                stream.put_nowait(message)
+            except queue.Full:
+                metrics.count("streams_dropped")
+                self.unsubscribe(stream)
+
+    def info(self):
+        with self.lock:
+            if self.data is None:
+                return {"name": self.name, "url": self.url, "version": 0}
+            header = self.data.header
+            return {
+                "name": self.name,
+                "url": self.url,
+                "version": self.data.version,
+                "title": header["title"],
+                "timeStamp": header["timeStamp"],
+                "events": len(self.data.events),
+                "streams": len(self.subscribers),
+            }
+
+    def query(self, criteria, sortName, offset, limit):
+        # output: (version, header, matching count, Events on the page)
+        with self.lock:
+            data = self.data
+            view = data.view(sortName)
+            rows = data.cached("filter", FilterIndex).select(criteria)
+            if rows is not None:
+                view = FilteredView(view, rows)
+            end = len(view) if limit is None else min(len(view),
+                                                      offset + limit)
+            events = data.events
+            page = [events.event(view.row(n)) for n in range(offset, end)]
+            return data.version, dict(data.header), len(view), page
+
+
+class FeedServer:
+    # The feeds being served, the thread that keeps them up to date and
+    # the cache of responses
+    def __init__(self, base=FEED_BASE, jobs=4):
+        self.base = base
+        self.services = {}
+        self.lock = threading.Lock()
+        self.scheduler = RefreshScheduler()
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        # (feed, version, query): {"body", "type", "etag", "gzip"}
+        self.responses = OrderedDict()
+        self.responsesLock = threading.Lock()
+
+    def service(self, name, load=True):
+        # The FeedService for a feed name, started the first time it is
+        # asked for.  With load the feed is fetched now if it is not
+        # held yet.
+        # output: FeedService, or None if the feed could not be got
+        with self.lock:
+            service = self.services.get(name)
+            if service is None:
+                service = FeedService(name, feedUrl(name, self.base))
+                self.services[name] = service
+                self.scheduler.add(service.url, now=not load)
+                self.wake.set()
+        if load and service.data is None and service.refresh() is None:
+            return None
+        return service
+
+    def _refresh(self, service):
+        try:
+            changed = service.refresh()
+        except Exception:
+            logging.exception(f"Error refreshing {service.name}")
+            changed = None
+        if changed is None:
+            logging.error(f"Could not get {service.url}")
+        self.scheduler.done(service.url, bool(changed), service.asked)
+
+    def run(self):
+        # Refresh the feeds as they fall due, until stop() is called
+        byUrl = {}
+        while not self.stopped.is_set():
+            due = self.scheduler.due()
+            if due:
+                with self.lock:
+                    byUrl = {s.url: s for s in self.services.values()}
+                for url in due:
+                    self.pool.submit(self._refresh, byUrl[url])
+            delay = self.scheduler.nextDelay()
+            delay = MAX_SLEEP if delay is None else min(delay, MAX_SLEEP)
+            self.wake.wait(delay)
+            self.wake.clear()
+
+    def start(self):
+        threading.Thread(target=self.run, name="Refresh",
+                         daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        self.pool.shutdown(wait=False)
+
+    def cachedResponse(self, key):
+        with self.responsesLock:
+            entry = self.responses.get(key)
+            if entry is not None:
+                self.responses.move_to_end(key)
+            return entry
+
+    def storeResponse(self, key, body, contentType):
+        entry = {
+            "body": body,
+            "type": contentType,
+            "etag": '"' + hashlib.sha1(body).hexdigest()[:20] + '"',
+            "gzip": None,
+        }
+        with self.responsesLock:
+            self.responses[key] = entry
+            while len(self.responses) > RESPONSE_CACHE_SIZE:
+                self.responses.popitem(last=False)
+        return entry
+
+    def feedResponse(self, name, params):
+        # The cached response for a query, or a new one
+        # output: response entry, or None if the feed could not be got
+        criteria, sortName, offset, limit, fmt = parseQuery(params)
+        service = self.service(name)
+        if service is None:
+            return None
+        with service.lock:
+            version = service.data.version
+        key = (name, version, tuple(sorted(params.items())))
+        entry = self.cachedResponse(key)
+        if entry is not None:
+            metrics.count("response_cache_hits")
+            return entry
+        metrics.count("response_cache_misses")
+        with metrics.timer("query"):
+            version, header, total, page = service.query(
+                criteria, sortName, offset, limit)
+            records = eventRecords(name, page)
+            if fmt == "json":
+                body = json.dumps({
+                    "feed": name,
+                    "version": version,
+                    "header": header,
+                    "total": total,
+                    "offset": offset,
+                    "events": list(records),
+                }).encode()
+            else:
+                out = io.StringIO(newline="")
+                writeRecords(records, out, fmt)
+                body = out.getvalue().encode()
+        # keyed by the version the page came from, which may be newer
+        # than the one looked up
+        return self.storeResponse((name, version, key[2]), body,
+                                  _contentTypes[fmt])
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # self.server.feeds is the FeedServer
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = parts.path.rstrip("/")
+        params = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        try:
+            if path == "/feeds":
+                self._feeds()
+            elif path.startswith("/feeds/") and path.endswith("/stream"):
+                self._stream(path[len("/feeds/"):-len("/stream")])
+            elif path.startswith("/feeds/"):
+                self._feed(path[len("/feeds/"):], params)
+            elif path == "/metrics":
+                self._send(metrics.toPrometheus().encode(),
+                           "text/plain; version=0.0.4")
+            elif path == "/metrics.json":
+                self._send(metrics.toJson().encode(), "application/json")
+            else:
+                self.send_error(404)
+        except QueryError as e:
+            self.send_error(400, str(e))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send(self, body, contentType, etag=None, encoding=None):
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _feeds(self):
+        feeds = self.server.feeds
+        with feeds.lock:
+            services = list(feeds.services.values())
+        body = json.dumps([s.info() for s in services]).encode()
+        self._send(body, "application/json")
+
+    def _feed(self, name, params):
+        # only the summary feeds, so clients cannot have the server
+        # poll any URL they make up
+        if name not in FEED_NAMES:
+            self.send_error(404)
+            return
+        entry = self.server.feeds.feedResponse(name, params)
+        if entry is None:
+            self.send_error(502, f"Could not get feed {name}")
+            return
+        if self.headers.get("If-None-Match") == entry["etag"]:
+            self.send_response(304)
+            self.send_header("ETag", entry["etag"])
+            self.end_headers()
+            return
+        body, encoding = entry["body"], None
+        if (len(body) > GZIP_BYTES
+                and "gzip" in self.headers.get("Accept-Encoding", "")):
+            # compressed once and kept with the response
+            if entry["gzip"] is None:
+                entry["gzip"] = gzip.compress(body, 6)
+            body, encoding = entry["gzip"], "gzip"
+        self._send(body, entry["type"], entry["etag"], encoding)
+
+    def _stream(self, name):
+        if name not in FEED_NAMES:
+            self.send_error(404)
+            return
+        service = self.server.feeds.service(name)
+        if service is None:
+            self.send_error(502, f"Could not get feed {name}")
+            return
+        stream = service.subscribe()
+        metrics.count("streams_opened")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            info = json.dumps(service.info())
+            self.wfile.write(f"event: ready\ndata: {info}\n\n".encode())
+            self.wfile.flush()
+            while service.isSubscribed(stream):
+                try:
+                    message = stream.get(timeout=KEEPALIVE)
+                except queue.Empty:
+                    message = b": keepalive\n\n"
+                self.wfile.write(message)
+                self.wfile.flush()
+        finally:
+            service.unsubscribe(stream)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve USGS earthquake feeds from one shared copy.")
+    parser.add_argument(
+        "feeds", nargs="*", default=["2.5_day"],
+        help="feeds to load at start, others are loaded when asked for "
+             "(default 2.5_day)")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help=f"port to listen on (default {PORT})")
+    parser.add_argument("--base-url", default=FEED_BASE,
+                        help="where to fetch the feeds from")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4,
+        help="feeds to refresh at the same time (default 4)")
+    args = parser.parse_args(argv)
+    for name in args.feeds:
+        if name not in FEED_NAMES:
+            parser.error(f"unknown feed {name}")
+    return args
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    feeds = FeedServer(args.base_url, args.jobs)
+    for name in args.feeds:
+        feeds.service(name, load=False)
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.feeds = feeds
+    feeds.start()
+    logging.info(f"serving on http://{args.host}:{args.port}/feeds")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        feeds.stop()
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+Description: Local stand-in for the USGS FDSN event service
+
+Answers /query like the real service from a canned list of GeoJSON
+features, so backfilling can be tried and tested offline.  It keeps to
+the parts of the service EarthquakeBackfill relies on: starttime,
+endtime and minmagnitude, newest first, a 400 "exceeds search limit"
+error for a query matching more than limit events, and gzip for
+clients that accept it.  failures are HTTP status codes answered, in
+order, to the first requests instead of the events.
+
+    python tests/fdsnStandIn.py features.geojson --limit 1000
+    python cliEarthquakes.py --backfill 2024-01-01 \\
+        --fdsn-url http://localhost:8769/
+"""
+
+import argparse
+import gzip
+import json
+import sys
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import logging
+
+PORT = 8769
+LIMIT = 20000
+
+
+def makeFeature(eventId, eventTime, mag=2.0, updated=None, lat=0.0,
+                lon=0.0, depth=10.0):
+    # A feature with the properties readFeed uses
+    return {
+        "type": "Feature",
+        "properties": {
+            "mag": mag,
+            "place": f"Place of {eventId}",
+            "time": eventTime,
+            "updated": eventTime if updated is None else updated,
+            "tz": None,
+            "url": "https://earthquake.usgs.gov/earthquakes/eventpage/"
+                   + eventId,
+            "felt": None,
+            "mmi": None,
+            "alert": None,
+            "sig": 0,
+        },
+        "geometry": {"type": "Point", "coordinates": [lon, lat, depth]},
+        "id": eventId,
+    }
+
+
+def _ms(text):
+    moment = datetime.fromisoformat(text)
+    return int(moment.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class FdsnStandIn:
+    def __init__(self, features, limit=LIMIT, failures=(), port=0,
+                 generated=0):
+        self.features = sorted(features,
+                               key=lambda f: f["properties"]["time"])
+        self.times = [f["properties"]["time"] for f in self.features]
+        self.limit = limit
+        self.generated = generated
+        self.lock = threading.Lock()
+        self.failures = list(failures)
+        # every query asked, and the status it was answered with
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self.server.standIn = self
+        self._thread = None
+
+    @property
+    def base(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def answer(self, query):
+        # (status, body) for the parameters of a query
+        with self.lock:
+            if self.failures:
+                status = self.failures.pop(0)
+                self.requests.append((query, status))
+                return status, b"Service unavailable"
+        start, end = _ms(query["starttime"]), _ms(query["endtime"])
+        first = bisect_left(self.times, start)
+        last = bisect_right(self.times, end)
+        minMag = float(query.get("minmagnitude", "-inf"))
+        found = [f for f in reversed(self.features[first:last])
+                 if (f["properties"]["mag"] or 0) >= minMag]
+        if len(found) > self.limit:
+            with self.lock:
+                self.requests.append((query, 400))
+            return 400, (
+                f"Error 400: Bad Request\n\n{len(found)} matching events "
+                f"exceeds search limit of {self.limit}. Modify the "
+                f"search to match fewer events.").encode()
+        metadata = {
+            "generated": self.generated,
+            "url": "stand-in",
+            "title": "USGS Earthquakes",
+            "status": 200,
+            "count": len(found),
+        }
+        with self.lock:
+            self.requests.append((query, 200))
+        return 200, json.dumps({"type": "FeatureCollection",
+                                "metadata": metadata,
+                                "features": found}).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path.rstrip("/") != "/query":
+            self.send_error(404)
+            return
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        status, body = self.server.standIn.answer(query)
+        self.send_response(status)
+        if (status == 200
+                and "gzip" in self.headers.get("Accept-Encoding", "")):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve canned events like the FDSN event service.")
+    parser.add_argument("features",
+                        help="GeoJSON file of the events to serve")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--limit", type=int, default=LIMIT,
+                        help=f"most events per query (default {LIMIT})")
+    args = parser.parse_args(argv)
+    with open(args.features, "r") as f:
+        data = json.load(f)
+    standIn = FdsnStandIn(data["features"], args.limit, port=args.port,
+                          generated=data.get("metadata", {}).get(
+                              "generated", 0))
+    logging.basicConfig(level=logging.INFO)
+    logging.info(f"serving {len(standIn.features):,} events on "
+                 f"{standIn.base}")
+    try:
+        standIn.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    standIn.server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
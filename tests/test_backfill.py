@@ -0,0 +1,136 @@
+"""
+Description: EarthquakeBackfill against the local FDSN stand-in
+
+Run from the top of the repository:
+
+    python -m unittest discover tests
+"""
+
+import unittest
+
+from EarthquakeBackfill import BackfillError, WINDOW_MS, backfill, windows
+from EarthquakeMetrics import metrics
+from fdsnStandIn import FdsnStandIn, makeFeature
+
+DAY_MS = 86400 * 1000
+END = 1700000000000
+# two of the 30 day windows
+START = END - 2 * WINDOW_MS
+
+
+def spread(count, start, end, prefix="ev"):
+    # count features evenly between start and end
+    step = (end - start) // (count + 1)
+    return [makeFeature(f"{prefix}{n}", start + (n + 1) * step,
+                        mag=1.0 + n % 5)
+            for n in range(count)]
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def runBackfill(self, features, parseJobs=1, **standIn):
+        with FdsnStandIn(features, **standIn) as service:
+            events = backfill(START, END, base=service.base, jobs=3,
+                              parseJobs=parseJobs, delay=0)
+        return events, service.requests
+
+    def assertNewestFirst(self, events):
+        times = list(events.time)
+        self.assertEqual(times, sorted(times, reverse=True))
+
+    def test_windows(self):
+        self.assertEqual(windows(START, END),
+                         [(END - WINDOW_MS, END), (START, END - WINDOW_MS)])
+
+    def test_every_event_once(self):
+        features = spread(40, START, END)
+        events, requests = self.runBackfill(features)
+        self.assertEqual(sorted(events.ids),
+                         sorted(f["id"] for f in features))
+        self.assertNewestFirst(events)
+        self.assertEqual([status for _, status in requests], [200, 200])
+
+    def test_split_on_limit(self):
+        # 25 events in the newer window and 5 in the older one, with
+        # at most 8 to a query
+        features = (spread(25, END - WINDOW_MS + 1, END, "new")
+                    + spread(5, START, END - WINDOW_MS - 1, "old"))
+        events, requests = self.runBackfill(features, limit=8)
+        self.assertEqual(sorted(events.ids),
+                         sorted(f["id"] for f in features))
+        self.assertNewestFirst(events)
+        self.assertIn(400, [status for _, status in requests])
+        self.assertGreater(metrics.data()["counters"]["backfill_splits"],
+                           1)
+
+    def test_too_many_in_the_shortest_window(self):
+        features = [makeFeature(f"same{n}", END - DAY_MS) for n in range(3)]
+        with FdsnStandIn(features, limit=2) as service:
+            with self.assertRaises(BackfillError):
+                backfill(START, END, base=service.base, delay=0)
+
+    def test_retry(self):
+        features = spread(10, START, END)
+        with self.assertLogs(level="WARNING") as logs:
+            events, requests = self.runBackfill(
+                features, failures=(503, 429, 500))
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(len(events), 10)
+        self.assertEqual(metrics.data()["counters"]["backfill_retries"], 3)
+        self.assertEqual([status for _, status in requests][:3],
+                         [503, 429, 500])
+
+    def test_give_up(self):
+        with FdsnStandIn(spread(10, START, END),
+                         failures=(503,) * 3) as service:
+            with self.assertRaises(BackfillError), self.assertLogs(
+                    level="WARNING"):
+                backfill(START, END, base=service.base, jobs=1,
+                         retries=2, delay=0)
+
+    def test_not_retried(self):
+        with FdsnStandIn(spread(10, START, END),
+                         failures=(404,)) as service:
+            with self.assertRaises(BackfillError):
+                backfill(START, END, base=service.base, jobs=1, delay=0)
+        self.assertEqual([status for _, status in service.requests
+                          if status == 404], [404])
+        self.assertNotIn("backfill_retries", metrics.data()["counters"])
+
+    def test_dedupe_by_id(self):
+        # an event exactly on the boundary between the windows is in
+        # both answers, and an event whose time was revised across the
+        # boundary is in both as different versions
+        boundary = END - WINDOW_MS
+        features = spread(6, START, END) + [
+            makeFeature("edge", boundary),
+            makeFeature("moved", boundary - DAY_MS, updated=1),
+            makeFeature("moved", boundary + DAY_MS, updated=2),
+        ]
+        events, _ = self.runBackfill(features)
+        self.assertEqual(len(events.ids), len(set(events.ids)))
+        self.assertEqual(len(events), 8)
+        moved = events.event(events.row("moved"))
+        self.assertEqual(moved.time, boundary + DAY_MS)
+        self.assertNewestFirst(events)
+
+    def test_parse_processes(self):
+        features = spread(30, START, END)
+        inThread, _ = self.runBackfill(features, limit=10)
+        inProcesses, _ = self.runBackfill(features, parseJobs=2, limit=10)
+        self.assertEqual(list(inProcesses.ids), list(inThread.ids))
+        self.assertEqual(list(inProcesses.mag), list(inThread.mag))
+
+    def test_min_magnitude(self):
+        features = spread(20, START, END)
+        with FdsnStandIn(features) as service:
+            events = backfill(START, END, minMag=4.0, base=service.base,
+                              delay=0)
+        self.assertEqual(len(events), 8)
+        self.assertGreaterEqual(min(events.mag), 4.0)
+
+
+if __name__ == "__main__":
+    unittest.main()